@@ -3,11 +3,21 @@ import math
 import numpy as np
 import scipy as sp
 import pandas as pd
+import os
 import json
 import csv
+import shutil
+import hashlib
+import functools
+import inspect
+import itertools
+import multiprocessing
 import warnings
 from numpy import testing
-from collections import OrderedDict
+from array import array
+from collections import OrderedDict, namedtuple
+from scipy.special import gammaln
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from cryptorandom.cryptorandom import SHA256, random
 from cryptorandom.sample import random_permutation
 from cryptorandom.sample import sample_by_index
@@ -76,13 +86,15 @@ class Assertion:
         find the mean of the assorter values for a list of CVRs        
         Parameters:
         ----------
-        cvr_list : list
+        cvr_list : list or CVRTable
             a list of cast-vote records
         
         Returns:
         ----------
         double
         """
+        if isinstance(cvr_list, CVRTable):
+            return self.assorter_sum(cvr_list)/len(cvr_list)
         return np.mean([self.assorter.assort(c) for c in cvr_list])      
         
     def assorter_sum(self, cvr_list):
@@ -90,13 +102,16 @@ class Assertion:
         find the sum of the assorter values for a list of CVRs        
         Parameters:
         ----------
-        cvr_list : list
+        cvr_list : list or CVRTable
             a list of cast-vote records
         
         Returns:
         ----------
         double
         """
+        if isinstance(cvr_list, CVRTable):
+            values, counts, inverse = self.assorter.assort_patterns(cvr_list)
+            return np.dot(values, counts)
         return np.sum([self.assorter.assort(c) for c in cvr_list])
 
     def assorter_margin(self, cvr_list):
@@ -214,11 +229,8 @@ class Assertion:
         for winr in winners:
             for losr in losers:
                 wl_pair = winr + ' v ' + losr                
-                assertions[wl_pair] = Assertion(contest, Assorter(contest=contest, \
-                                      assort = lambda c, contest=contest, winr=winr, losr=losr:\
-                                      ( CVR.as_vote(CVR.get_vote_from_cvr(contest, winr, c)) \
-                                      - CVR.as_vote(CVR.get_vote_from_cvr(contest, losr, c)) \
-                                      + 1)/2, upper_bound = 1))
+                assertions[wl_pair] = Assertion(contest, Assorter.from_spec(\
+                                      AssorterSpec('plurality', contest, winr, losr)))
         return assertions
     
     @classmethod
@@ -258,14 +270,9 @@ class Assertion:
 
         assertions = {}
         wl_pair = winner + ' v all'
-        cands = losers.copy()
-        cands.append(winner)
-        assertions[wl_pair] = Assertion(contest, \
-                                 Assorter(contest=contest, assort = lambda c, contest=contest: \
-                                 CVR.as_vote(CVR.get_vote_from_cvr(contest, winner, \
-                                 c))/(2*share_to_win) \
-                                 if CVR.has_one_vote(contest, cands, c) else 1/2,\
-                                 upper_bound = 1/(2*share_to_win) ))
+        assertions[wl_pair] = Assertion(contest, Assorter.from_spec(\
+                                 AssorterSpec('supermajority', contest, winner, list(losers), \
+                                              share_to_win=share_to_win)))
         return assertions
 
     @classmethod
@@ -302,19 +309,9 @@ class Assertion:
                 raise ValueError("assertion type " + assrtn['assertion_type'])
             
             elif assrtn['assertion_type'] == "WINNER_ONLY":
-                # CVR is a vote for the winner only if it has the 
-                # winner as its first preference
-                winner_func = lambda v, contest=contest, winr=winr : 1 \
-                              if CVR.get_vote_from_cvr(contest, winr, v) == 1 else 0
-
-                # CVR is a vote for the loser if they appear and the 
-                # winner does not, or they appear before the winner
-                loser_func = lambda v, contest=contest, winr=winr, losr=losr : \
-                             CVR.rcv_lfunc_wo(contest, winr, losr, v)
-
                 wl_pair = winr + ' v ' + losr
-                assertions[wl_pair] = Assertion(contest, Assorter(contest=contest, winner=winner_func, \
-                                                loser=loser_func, upper_bound=1))
+                assertions[wl_pair] = Assertion(contest, Assorter.from_spec(\
+                                                AssorterSpec('irv_winner_only', contest, winr, losr)))
 
             elif assrtn['assertion_type'] == "IRV_ELIMINATION": 
                 # Context is that all candidates in 'eliminated' have been
@@ -323,11 +320,9 @@ class Assertion:
                 remn = [c for c in candidates if c not in elim]
                 # Identifier for tracking which assertions have been proved
                 wl_given = winr + ' v ' + losr + ' elim ' + ' '.join(elim)
-                assertions[wl_given] = Assertion(contest, Assorter(contest=contest, \
-                                       assort = lambda v, contest=contest, winr=winr, losr=losr, remn=remn : \
-                                       ( CVR.rcv_votefor_cand(contest, winr, remn, v) \
-                                       - CVR.rcv_votefor_cand(contest, losr, remn, v) +1)/2,\
-                                       upper_bound = 1))
+                assertions[wl_given] = Assertion(contest, Assorter.from_spec(\
+                                       AssorterSpec('irv_elimination', contest, winr, losr, \
+                                                    remaining=remn)))
             else:
                 raise NotImplemented('JSON assertion type %s not implemented. ' \
                                       % assertn['assertion_type'])
@@ -365,6 +360,22 @@ class Assertion:
                 raise NotImplementedError("Social choice function " + scf + " is not supported")
         return all_assertions
 
+AssorterSpec = namedtuple('AssorterSpec', 'kind, contest, winner, loser, share_to_win, remaining', \
+                          defaults=(None, None))
+AssorterSpec.__doc__ = """
+Declarative description of one of the standard assorters; see Assorter.from_spec.
+
+kind : one of Assorter.SPEC_KINDS
+contest : identifier of the contest
+winner : identifier of the winner
+loser : identifier of the loser; for 'supermajority', the list of losers
+share_to_win : for 'supermajority', the fraction of the valid votes the winner must get
+remaining : for 'irv_elimination', the candidates not yet eliminated
+
+An AssorterSpec is a tuple of strings, lists and numbers, so it can be pickled, written as 
+json (json.dumps(spec)), and read back with AssorterSpec(*json.loads(s)).
+"""
+
 class Assorter:
     """
     Class for generic Assorter.
@@ -388,15 +399,34 @@ class Assorter:
     
     upper_bound : double
         a priori upper bound on the value the assorter assigns to any dict of selections
+        
+    candidates : list
+        identifiers of the candidates whose votes the assorter depends on, in the column order
+        assort_batch expects
+        
+    assort_batch : callable
+        maps an integer array of ranks (ballots x candidates, 0 meaning no vote, as stored in a
+        CVRTable) into the array of assorter values for those ballots
 
     The basic method is assort, but the constructor can be called with (winner, loser)
     instead. In that case,
     
         assort = (winner - loser + 1)/2
+    
+    assort is the reference implementation; assort_batch, if given, must agree with it on 
+    every ballot that contains the contest.
+    
+    spec : AssorterSpec
+        for the standard assorters, made by from_spec(), the description they were built from.
+        Their callables are functools.partial objects of methods, not closures, so these 
+        Assorters can be pickled, e.g., for worker processes.
 
     """
+    
+    SPEC_KINDS = ['plurality', 'supermajority', 'irv_winner_only', 'irv_elimination']
         
-    def __init__(self, contest=None, assort=None, winner=None, loser=None, upper_bound = 1):
+    def __init__(self, contest=None, assort=None, winner=None, loser=None, upper_bound = 1, \
+                 candidates=None, assort_batch=None, spec=None):
         """
         Constructs an Assorter.
         
@@ -414,11 +444,23 @@ class Assorter:
             maps a pattern into {0, 1}
         loser  : callable
             maps a pattern into {0, 1}
+        candidates : list
+            identifiers of the candidates that index the columns of the argument of assort_batch
+        assort_batch : callable
+            vectorized assort: maps an array of ranks into an array of assorter values
+        spec : AssorterSpec
+            the description of the assorter, if it has one
         """   
+        self.spec = spec
         self.contest = contest
         self.winner = winner
         self.loser = loser
         self.upper_bound = upper_bound
+        self.candidates = candidates
+        if assort_batch is not None:
+            assert callable(assort_batch), "assort_batch must be callable"
+            assert candidates is not None, "assort_batch requires the list of candidates"
+        self.assort_batch = assort_batch
         if assort is not None:
             assert callable(assort), "assort must be callable"
             self.assort = assort
@@ -451,6 +493,145 @@ class Assorter:
     def get_upper_bound(self):
         return self.upper_bound
 
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Build one of the standard assorters from its declarative description.
+        
+        'plurality' : the vote for the winner minus the vote for the loser, plus 1, over 2
+        'supermajority' : the vote for the winner over 2*share_to_win if the ballot has exactly
+            one vote among the winner and losers; 1/2 otherwise
+        'irv_winner_only' : the winner is first choice, vs. the loser is ranked above the winner 
+            (or without the winner); see CVR.rcv_lfunc_wo
+        'irv_elimination' : the first choice among the remaining candidates is the winner, vs.
+            it is the loser; see CVR.rcv_votefor_cand
+        
+        Parameters:
+        -----------
+        spec : AssorterSpec, or a tuple, list or dict with its fields
+        
+        Returns:
+        --------
+        Assorter with assort and assort_batch for the spec
+        """
+        spec = AssorterSpec(**spec) if isinstance(spec, dict) else AssorterSpec(*spec)
+        kind, contest, winr, losr = spec.kind, spec.contest, spec.winner, spec.loser
+        if kind == 'plurality':
+            return Assorter(contest=contest, assort=functools.partial(Assorter._plurality, \
+                            contest, winr, losr), upper_bound=1, candidates=[winr, losr], \
+                            assort_batch=Assorter._plurality_batch, spec=spec)
+        elif kind == 'supermajority':
+            cands = list(losr) + [winr]
+            return Assorter(contest=contest, assort=functools.partial(Assorter._supermajority, \
+                            contest, winr, cands, spec.share_to_win), \
+                            upper_bound=1/(2*spec.share_to_win), candidates=cands, \
+                            assort_batch=functools.partial(Assorter._supermajority_batch, \
+                            spec.share_to_win), spec=spec)
+        elif kind == 'irv_winner_only':
+            return Assorter(contest=contest, \
+                            winner=functools.partial(Assorter._first_choice, contest, winr), \
+                            loser=functools.partial(CVR.rcv_lfunc_wo, contest, winr, losr), \
+                            assort=functools.partial(Assorter._irv_winner_only, contest, winr, losr),\
+                            upper_bound=1, candidates=[winr, losr], \
+                            assort_batch=Assorter._irv_winner_only_batch, spec=spec)
+        elif kind == 'irv_elimination':
+            remn = list(spec.remaining)
+            # columns of the rank matrix are the remaining candidates
+            cols = list(range(len(remn)))
+            wcol = remn.index(winr) if winr in remn else None
+            lcol = remn.index(losr) if losr in remn else None
+            return Assorter(contest=contest, assort=functools.partial(Assorter._irv_elimination, \
+                            contest, winr, losr, remn), upper_bound=1, candidates=remn, \
+                            assort_batch=functools.partial(Assorter._irv_elimination_batch, \
+                            wcol, lcol, cols), spec=spec)
+        raise NotImplementedError("assorter kind " + str(kind) + " is not supported")
+    
+    @staticmethod
+    def _plurality(contest, winr, losr, cvr):
+        return (CVR.as_vote(CVR.get_vote_from_cvr(contest, winr, cvr)) \
+                - CVR.as_vote(CVR.get_vote_from_cvr(contest, losr, cvr)) + 1)/2
+    
+    @staticmethod
+    def _plurality_batch(r):
+        return (CVRTable.as_vote(r[:, 0]) - CVRTable.as_vote(r[:, 1]) + 1)/2
+    
+    @staticmethod
+    def _supermajority(contest, winr, cands, share_to_win, cvr):
+        return CVR.as_vote(CVR.get_vote_from_cvr(contest, winr, cvr))/(2*share_to_win) \
+               if CVR.has_one_vote(contest, cands, cvr) else 1/2
+    
+    @staticmethod
+    def _supermajority_batch(share_to_win, r):
+        return np.where(CVRTable.has_one_vote(r), CVRTable.as_vote(r[:, -1])/(2*share_to_win), 1/2)
+    
+    @staticmethod
+    def _first_choice(contest, winr, cvr):
+        # CVR is a vote for the winner only if it has the winner as its first preference
+        return 1 if CVR.get_vote_from_cvr(contest, winr, cvr) == 1 else 0
+    
+    @staticmethod
+    def _irv_winner_only(contest, winr, losr, cvr):
+        # CVR is a vote for the loser if they appear and the winner does not, or they appear 
+        # before the winner
+        return (Assorter._first_choice(contest, winr, cvr) \
+                - CVR.rcv_lfunc_wo(contest, winr, losr, cvr) + 1)/2
+    
+    @staticmethod
+    def _irv_winner_only_batch(r):
+        # the same, for a matrix of ranks with columns [winr, losr]
+        return ((r[:, 0] == 1).astype(int) - CVRTable.rcv_lfunc_wo(r, 0, 1) + 1)/2
+    
+    @staticmethod
+    def _irv_elimination(contest, winr, losr, remn, cvr):
+        return (CVR.rcv_votefor_cand(contest, winr, remn, cvr) \
+                - CVR.rcv_votefor_cand(contest, losr, remn, cvr) + 1)/2
+    
+    @staticmethod
+    def _irv_elimination_batch(wcol, lcol, cols, r):
+        return (CVRTable.rcv_votefor_cand(r, wcol, cols) - CVRTable.rcv_votefor_cand(r, lcol, cols) \
+                + 1)/2
+    
+    def assort_patterns(self, cvr_table):
+        """
+        Assorter values for the distinct vote patterns in the contest in a CVRTable.
+        
+        Uses assort_batch on the table's distinct rank patterns for the contest (see 
+        CVRTable.patterns), so the work is proportional to the number of distinct patterns,
+        not the number of ballots. If assort_batch is not defined, applies assort to each
+        CVR in turn, treating every ballot as its own pattern.
+        
+        Parameters:
+        -----------
+        cvr_table : CVRTable
+        
+        Returns:
+        --------
+        values : array of assorter values, one per pattern
+        counts : array of the number of ballots with each pattern
+        inverse : array of the pattern of each ballot
+        """
+        if self.assort_batch is None:
+            values = np.array([self.assort(c) for c in cvr_table], dtype=float)
+            return values, np.ones(len(values), dtype=np.int64), np.arange(len(values))
+        patterns, counts, inverse = cvr_table.patterns(self.contest)
+        ranks = cvr_table.rank_matrix(self.contest, self.candidates, ranks=patterns)
+        return np.asarray(self.assort_batch(ranks), dtype=float), counts, inverse
+
+    def assort_table(self, cvr_table):
+        """
+        Assorter values for every ballot in a CVRTable.
+        
+        Parameters:
+        -----------
+        cvr_table : CVRTable
+        
+        Returns:
+        --------
+        array of assorter values, one per ballot
+        """
+        values, counts, inverse = self.assort_patterns(cvr_table)
+        return values[inverse]
+
 
 class CVR:
     """
@@ -582,6 +763,8 @@ class CVR:
             The CVR file is assumed to have been read using csv.reader(), so each row has
             been split.
             
+            To read a large file without holding it in memory, use CVRTable.from_raire().
+            
         Returns:
         --------
         list of CVR objects corresponding to the RAIRE cvrs
@@ -786,6 +969,639 @@ class CVR:
                     return 0
             return 1 
 
+class _CVRTableBuilder:
+    """
+    Accumulates cast-vote records one record at a time and assembles them into a CVRTable.
+    
+    Votes are held as flat integer arrays of (row, candidate, rank, record number) entries,
+    so the memory needed while building is proportional to the number of marks, not to the
+    number of Python dicts. Records that mention a ballot id already seen are merged with the
+    same semantics as CVR.merge_cvrs: a later mention of a contest replaces the votes in that
+    contest, and the ballot is a phantom only if every mention is a phantom.
+    """
+    
+    def __init__(self):
+        self.rows = {}
+        self.phantom = array('b')
+        self.contests = OrderedDict()
+        self.n_records = 0
+    
+    def add_contest(self, contest, candidates=()):
+        """
+        Register a contest and (optionally) the order of its candidates.
+        """
+        contest = str(contest)
+        if contest not in self.contests:
+            self.contests[contest] = {'candidates': OrderedDict(), 'mentions': array('q'), \
+                                      'mention_seq': array('q'), 'rows': array('q'), \
+                                      'cols': array('q'), 'ranks': array('q'), 'seq': array('q')}
+        cands = self.contests[contest]['candidates']
+        for cand in candidates:
+            cands.setdefault(str(cand), len(cands))
+        return self.contests[contest]
+    
+    def add(self, id, votes, phantom=False):
+        """
+        Add one record.
+        
+        Parameters:
+        -----------
+        id : ballot identifier
+        votes : dict
+            dict of dicts of votes, keyed by contest and then by candidate
+        phantom : Boolean
+        """
+        row, seq = self.add_record(id, phantom)
+        for contest, contest_votes in votes.items():
+            con = self.add_contest(contest)
+            con['mentions'].append(row)
+            con['mention_seq'].append(seq)
+            cands = con['candidates']
+            for cand, vote in contest_votes.items():
+                rank = CVRTable.as_rank(vote)
+                if rank:
+                    col = cands.setdefault(str(cand), len(cands))
+                    con['rows'].append(row)
+                    con['cols'].append(col)
+                    con['ranks'].append(rank)
+                    con['seq'].append(seq)
+        return row
+    
+    def add_record(self, id, phantom=False):
+        """
+        Start a record for ballot id; returns the row of the ballot and the record number.
+        """
+        row = self.rows.get(id)
+        if row is None:
+            row = len(self.rows)
+            self.rows[id] = row
+            self.phantom.append(bool(phantom))
+        else:
+            self.phantom[row] = self.phantom[row] and bool(phantom)
+        seq = self.n_records
+        self.n_records += 1
+        return row, seq
+    
+    def add_ranking(self, id, contest, ranking, phantom=False):
+        """
+        Add one record containing a single contest, given as a list of candidates in rank 
+        order: ranking[0] gets rank 1, ranking[1] rank 2, etc.
+        """
+        row, seq = self.add_record(id, phantom)
+        con = self.add_contest(contest)
+        con['mentions'].append(row)
+        con['mention_seq'].append(seq)
+        cands = con['candidates']
+        for rank, cand in enumerate(ranking, start=1):
+            con['rows'].append(row)
+            con['cols'].append(cands.setdefault(cand, len(cands)))
+            con['ranks'].append(rank)
+            con['seq'].append(seq)
+        return row
+    
+    def build(self):
+        """
+        Assemble the CVRTable
+        """
+        n = len(self.rows)
+        has_contest = np.zeros((n, len(self.contests)), dtype=bool)
+        candidates = OrderedDict()
+        ranks = {}
+        for j, (contest, con) in enumerate(self.contests.items()):
+            last_seq = np.full(n, -1, dtype=np.int64)
+            np.maximum.at(last_seq, np.frombuffer(con['mentions'], dtype=np.int64), \
+                          np.frombuffer(con['mention_seq'], dtype=np.int64))
+            has_contest[:, j] = last_seq >= 0
+            rows = np.frombuffer(con['rows'], dtype=np.int64)
+            cols = np.frombuffer(con['cols'], dtype=np.int64)
+            vals = np.frombuffer(con['ranks'], dtype=np.int64)
+            keep = np.frombuffer(con['seq'], dtype=np.int64) == last_seq[rows]
+            dtype = np.promote_types(np.min_scalar_type(vals.min()), np.min_scalar_type(vals.max())) \
+                    if len(vals) else np.uint8
+            mat = np.zeros((n, len(con['candidates'])), dtype=dtype)
+            mat[rows[keep], cols[keep]] = vals[keep]
+            candidates[contest] = list(con['candidates'])
+            ranks[contest] = mat
+        return CVRTable(ids=CVRTable.id_array(list(self.rows)), phantom=np.frombuffer(self.phantom, \
+                        dtype=np.int8).astype(bool), contests=list(self.contests), \
+                        candidates=candidates, has_contest=has_contest, ranks=ranks)
+
+
+class CVRTable:
+    """
+    Columnar, array-backed store for a collection of cast-vote records.
+    
+    Instead of one CVR object (with a dict of dicts of votes) per ballot, a CVRTable keeps
+        ids : array of ballot identifiers
+        phantom : boolean array of phantom flags
+        contests : list of contest identifiers; contest j is column j of has_contest
+        candidates : dict of lists of candidate identifiers for each contest
+        has_contest : boolean array, ballots x contests; does the ballot contain the contest?
+        ranks : dict of integer arrays, one per contest, ballots x candidates in that contest.
+            Entry [i, k] is the rank (or mark) ballot i gives candidate k; 0 means no vote.
+    
+    Votes are interned with CVRTable.as_rank: nonnegative integer ranks keep their value, other
+    values become 1 if they cast as boolean True and 0 otherwise. All the assorters only use the 
+    truth value of a vote and the order of ranks, so this loses nothing they depend on.
+    
+    A CVRTable behaves like a list of CVRs: len(), iteration and indexing yield CVR objects 
+    built from the corresponding row, so it can be passed wherever a cvr_list is expected.
+    Rows are built on demand; changing a row does not change the table.
+    
+    The distinct vote patterns in each contest, with their counts, are found once and cached 
+    (see patterns()); assorter means and margins are computed from the weighted patterns.
+    """
+    
+    SAVE_FORMAT = 1  # version of the layout written by save(); part of the key of cached()
+    
+    def __init__(self, ids, phantom, contests, candidates, has_contest, ranks):
+        self.ids = ids
+        self.phantom = phantom
+        self.contests = list(contests)
+        self.contest_index = {c: j for j, c in enumerate(self.contests)}
+        self.candidates = candidates
+        self.candidate_index = {c: {cand: k for k, cand in enumerate(candidates[c])} \
+                                for c in self.contests}
+        self.has_contest = has_contest
+        self.ranks = ranks
+        self._patterns = {}
+        
+    def __len__(self):
+        return len(self.ids)
+    
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.get_cvr(int(i))
+        return [self.get_cvr(int(j)) for j in np.arange(len(self))[i]]
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_cvr(i)
+    
+    def __str__(self):
+        return "CVRTable: " + str(len(self)) + " ballots, contests: " + str(self.contests)
+    
+    @property
+    def nbytes(self):
+        """
+        bytes used by the arrays in the table
+        """
+        return self.ids.nbytes + self.phantom.nbytes + self.has_contest.nbytes \
+               + np.sum([r.nbytes for r in self.ranks.values()], dtype=int)
+        
+    def get_id(self, i):
+        if self.ids.dtype.kind == 'S':
+            return self.ids[i].decode('utf-8')
+        return self.ids[i].item() if self.ids.dtype != object else self.ids[i]
+        
+    def get_votes(self, i):
+        """
+        dict of dicts of votes on ballot i
+        """
+        votes = {}
+        for j in np.flatnonzero(self.has_contest[i]):
+            contest = self.contests[j]
+            row = self.ranks[contest][i]
+            votes[contest] = {self.candidates[contest][k]: int(row[k]) for k in np.flatnonzero(row)}
+        return votes
+    
+    def get_cvr(self, i):
+        """
+        CVR object for ballot i
+        """
+        return CVR(id=self.get_id(i), votes=self.get_votes(i), phantom=bool(self.phantom[i]))
+    
+    def to_cvrs(self):
+        return list(self)
+    
+    def contest_mask(self, contest):
+        """
+        boolean array: which ballots contain the contest?
+        """
+        if contest not in self.contest_index:
+            return np.zeros(len(self), dtype=bool)
+        return self.has_contest[:, self.contest_index[contest]]
+    
+    def rank_matrix(self, contest, candidates, ranks=None):
+        """
+        Ranks for the listed candidates in a contest, ballots x candidates.
+        
+        Candidates that do not appear in the contest get a column of zeros.
+        
+        Parameters:
+        -----------
+        contest : string
+            identifier of the contest
+        candidates : list
+            identifiers of candidates, in the column order wanted
+        ranks : array
+            rows to select the columns from, in the column order of the contest's rank matrix,
+            e.g., the distinct patterns from patterns(). Default: the ranks on every ballot
+        
+        Returns:
+        --------
+        integer array
+        """
+        if ranks is None:
+            ranks = self.ranks.get(contest, np.zeros((len(self), 0), dtype=np.int64))
+        out = np.zeros((len(ranks), len(candidates)), dtype=np.int64)
+        if contest in self.ranks:
+            cols = self.candidate_index[contest]
+            for k, cand in enumerate(candidates):
+                if str(cand) in cols:
+                    out[:, k] = ranks[:, cols[str(cand)]]
+        return out
+    
+    def patterns(self, contest):
+        """
+        The distinct vote patterns in a contest and how many ballots have each.
+        
+        A pattern is a row of the contest's rank matrix. Ballots that do not contain the
+        contest have the all-zero pattern. The result is computed once per contest and cached.
+        
+        Parameters:
+        -----------
+        contest : string
+            identifier of the contest
+        
+        Returns:
+        --------
+        patterns : integer array, distinct patterns x candidates in the contest
+        counts : array of the number of ballots with each pattern
+        inverse : array of the index of the pattern of each ballot
+        """
+        if contest not in self._patterns:
+            if contest in self.ranks:
+                patterns, inverse, counts = np.unique(self.ranks[contest], axis=0, \
+                                                      return_inverse=True, return_counts=True)
+                inverse = inverse.reshape(-1)
+            else:
+                patterns = np.zeros((1, 0), dtype=np.uint8)
+                counts = np.array([len(self)])
+                inverse = np.zeros(len(self), dtype=np.int64)
+            self._patterns[contest] = (patterns, counts, inverse)
+        return self._patterns[contest]
+    
+    @classmethod
+    def as_rank(cls, v):
+        """
+        Intern a vote as a nonnegative integer: nonnegative integer ranks (including integral
+        floats) keep their value, anything else is 1 if it casts as boolean True and 0 
+        otherwise. Thus CVRTable.as_vote(as_rank(v)) == CVR.as_vote(v) for every vote v.
+        """
+        if isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) and v >= 0:
+            return int(v)
+        if isinstance(v, (float, np.floating)) and float(v).is_integer() and v >= 0:
+            return int(v)
+        return int(bool(v))
+    
+    @classmethod
+    def id_array(cls, ids):
+        """
+        Store ballot ids compactly: string ids as UTF-8 bytes, integer ids as integers, and
+        anything else (e.g., a mix of types) as an object array.
+        """
+        if all(isinstance(i, str) for i in ids):
+            return np.array([i.encode('utf-8') for i in ids], dtype=bytes) if len(ids) \
+                   else np.array([], dtype=bytes)
+        if all(isinstance(i, (int, np.integer)) and not isinstance(i, bool) for i in ids):
+            return np.array(ids, dtype=np.int64)
+        out = np.empty(len(ids), dtype=object)
+        out[:] = ids
+        return out
+    
+    @classmethod
+    def as_vote(cls, r):
+        """
+        vectorized CVR.as_vote: 1 where there is a vote, 0 otherwise
+        """
+        return (np.asarray(r) > 0).astype(int)
+    
+    @classmethod
+    def has_one_vote(cls, ranks):
+        """
+        vectorized CVR.has_one_vote: is there exactly one vote in each row of ranks?
+        """
+        return np.count_nonzero(ranks, axis=1) == 1
+    
+    @classmethod
+    def rcv_lfunc_wo(cls, ranks, winner, loser):
+        """
+        vectorized CVR.rcv_lfunc_wo
+        
+        Parameters:
+        -----------
+        ranks : array of ranks, ballots x candidates
+        winner : int
+            column of the winning candidate
+        loser : int
+            column of the losing candidate
+        
+        Returns:
+        --------
+        array: 1 where the ballot is a vote for the loser and 0 otherwise
+        """
+        rank_winner = ranks[:, winner]
+        rank_loser = ranks[:, loser]
+        return ((rank_loser > 0) & ((rank_winner == 0) | (rank_loser < rank_winner))).astype(int)
+    
+    @classmethod
+    def rcv_votefor_cand(cls, ranks, cand, remaining):
+        """
+        vectorized CVR.rcv_votefor_cand
+        
+        Parameters:
+        -----------
+        ranks : array of ranks, ballots x candidates
+        cand : int or None
+            column of the candidate; None if the candidate is not in `remaining`
+        remaining : list of ints
+            columns of the candidates still standing
+        
+        Returns:
+        --------
+        array: 1 where the ballot counts as a vote for cand and 0 otherwise
+        """
+        if cand is None or cand not in remaining:
+            return np.zeros(len(ranks), dtype=int)
+        rank_cand = ranks[:, [cand]]
+        others = ranks[:, [c for c in remaining if c != cand]]
+        ahead = np.any((others > 0) & (others <= rank_cand), axis=1)
+        return ((rank_cand[:, 0] > 0) & ~ahead).astype(int)
+    
+    @classmethod
+    def from_raire(cls, raire, phantom=False):
+        """
+        Build a CVRTable from cvrs in RAIRE format, in a single streaming pass.
+        
+        Rows that mention a ballot id already seen are merged on the fly, with the semantics of 
+        CVR.merge_cvrs, so the result is the same as CVRTable.from_cvrs(CVR.from_raire(raire)), 
+        but the file is never held in memory as a list of rows or of CVR objects. 
+        The candidates in each contest are numbered in the order of the contest header line.
+        
+        Parameters:
+        -----------
+        raire : string, path, file object, or iterable of lists
+            the name of a file in RAIRE format (see CVR.from_raire), an open file, or rows
+            of such a file that have already been split, e.g., by csv.reader()
+        phantom : Boolean
+            flag every CVR as a phantom?
+            
+        Returns:
+        --------
+        CVRTable
+        """
+        if isinstance(raire, (str, os.PathLike)):
+            with open(raire, newline='') as f:
+                return cls.from_raire(f, phantom=phantom)
+        rows = csv.reader(raire) if hasattr(raire, 'read') else iter(raire)
+        builder = _CVRTableBuilder()
+        skip = int(next(rows)[0])
+        for i in range(skip):
+            c = next(rows)
+            builder.add_contest(c[1], c[3:])
+        for c in rows:
+            if c:
+                builder.add_ranking(c[1], c[0], c[2:], phantom=phantom)
+        return builder.build()
+    
+    @classmethod
+    def merge(cls, tables):
+        """
+        Merge a list of CVRTables into one, in order, with the semantics of CVR.merge_cvrs:
+        ballots appear in the order of their first mention; if a later table has votes for 
+        a ballot in a contest, they replace the earlier votes in that contest; a ballot is a
+        phantom only if it is a phantom in every table that lists it.
+        
+        Parameters:
+        -----------
+        tables : list of CVRTables
+        
+        Returns:
+        --------
+        CVRTable
+        """
+        tables = list(tables)
+        if len(tables) == 0:  # as CVR.merge_cvrs([]) is empty
+            return CVRTable.from_cvrs([])
+        if len(tables) == 1:
+            return tables[0]
+        if all(t.ids.dtype.kind == 'S' for t in tables) or all(t.ids.dtype.kind == 'i' for t in tables):
+            ids = np.concatenate([t.ids for t in tables])
+            uniq, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+            order = np.argsort(first, kind='stable')  # distinct ids, in order of first mention
+            position = np.empty(len(order), dtype=np.int64)
+            position[order] = np.arange(len(order))
+            rows = position[inverse.reshape(-1)]
+            distinct = uniq[order]
+        else: # ids of different types cannot be sorted together; number them in a dict
+            position = {}
+            rows = np.array([position.setdefault(t.get_id(i), len(position)) for t in tables \
+                             for i in range(len(t))], dtype=np.int64)
+            distinct = CVRTable.id_array(list(position))
+        n = len(distinct)
+        phantom = np.ones(n, dtype=bool)
+        np.logical_and.at(phantom, rows, np.concatenate([t.phantom for t in tables]))
+        contests = list(OrderedDict.fromkeys(c for t in tables for c in t.contests))
+        candidates = OrderedDict((c, list(OrderedDict.fromkeys(cand for t in tables \
+                                 if c in t.candidates for cand in t.candidates[c]))) for c in contests)
+        has_contest = np.zeros((n, len(contests)), dtype=bool)
+        ranks = {}
+        for c in contests:
+            dtype = np.result_type(*[t.ranks[c] for t in tables if c in t.ranks])
+            ranks[c] = np.zeros((n, len(candidates[c])), dtype=dtype)
+        offset = 0
+        for t in tables:
+            table_rows = rows[offset:offset+len(t)]
+            offset += len(t)
+            for c in t.contests:
+                j = contests.index(c)
+                r = table_rows[t.contest_mask(c)]
+                cols = [candidates[c].index(cand) for cand in t.candidates[c]]
+                has_contest[r, j] = True
+                ranks[c][r] = 0
+                ranks[c][np.ix_(r, cols)] = t.ranks[c][t.contest_mask(c)]
+        return CVRTable(ids=distinct, phantom=phantom, contests=contests, \
+                        candidates=candidates, has_contest=has_contest, ranks=ranks)
+    
+    @classmethod
+    def from_files(cls, files, reader=None, max_workers=None):
+        """
+        Read several CVR files, in parallel, and merge the results in the order of the files
+        (see CVRTable.merge), so the result does not depend on which worker finished first.
+        
+        Parameters:
+        -----------
+        files : list
+            the files to read
+        reader : callable
+            maps one element of `files` to a CVRTable. Must be picklable (e.g., a module-level
+            function, a classmethod, or a functools.partial of one) to run in worker processes.
+            Default: CVRTable.from_raire
+        max_workers : int
+            number of worker processes. Default: the number of CPUs. 
+            If 1, the files are read in this process.
+            
+        Returns:
+        --------
+        CVRTable
+        """
+        reader = CVRTable.from_raire if reader is None else reader
+        files = list(files)
+        if max_workers == 1 or len(files) <= 1:
+            return CVRTable.merge([reader(f) for f in files])
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return CVRTable.merge(list(executor.map(reader, files)))
+    
+    def save(self, directory):
+        """
+        Write the table to a directory as .npy files (one per array) and a json index.
+        The files can be reopened with CVRTable.load() as memory maps.
+        
+        The json index is written last, so a directory with an index is complete.
+        
+        Parameters:
+        -----------
+        directory : string
+            where to write the table. Created if it does not exist.
+        """
+        if self.ids.dtype == object:
+            raise ValueError("only tables whose ids are all strings or all integers can be saved")
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'ids.npy'), self.ids)
+        np.save(os.path.join(directory, 'phantom.npy'), self.phantom)
+        np.save(os.path.join(directory, 'has_contest.npy'), self.has_contest)
+        for j, c in enumerate(self.contests):
+            np.save(os.path.join(directory, 'ranks_{}.npy'.format(j)), self.ranks[c])
+        with open(os.path.join(directory, 'index.json'), 'w') as f:
+            json.dump({'format': CVRTable.SAVE_FORMAT, 'contests': self.contests, \
+                       'candidates': self.candidates}, f)
+    
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Read a table written by CVRTable.save().
+        
+        By default the arrays are memory-mapped read-only, so opening the table is nearly 
+        instantaneous and processes that open the same table share its pages.
+        
+        Parameters:
+        -----------
+        directory : string
+        mmap_mode : string
+            passed to numpy.load; None reads the arrays into memory
+        
+        Returns:
+        --------
+        CVRTable
+        """
+        with open(os.path.join(directory, 'index.json')) as f:
+            index = json.load(f)
+        load = lambda name: np.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+        ranks = {c: load('ranks_{}.npy'.format(j)) for j, c in enumerate(index['contests'])}
+        return CVRTable(ids=load('ids.npy'), phantom=load('phantom.npy'), \
+                        contests=index['contests'], candidates=index['candidates'], \
+                        has_contest=load('has_contest.npy'), ranks=ranks)
+    
+    @classmethod
+    def source_hash(cls, files, tag=''):
+        """
+        SHA-256 hex digest of the contents of a list of files, in order, and a tag.
+        """
+        h = hashlib.sha256(str(tag).encode('utf-8'))
+        for name in files:
+            h.update(b'\0')
+            with open(name, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    h.update(block)
+        return h.hexdigest()
+    
+    @classmethod
+    def reader_tag(cls, reader):
+        """
+        Identity of a reader for the cache key of cached(): the module and qualified name of the
+        function, with all the arguments of a functools.partial. None for lambdas and locally 
+        defined functions, which cannot be told apart by name.
+        """
+        args = ''
+        if isinstance(reader, functools.partial):
+            args = repr(reader.args) + repr(sorted(reader.keywords.items()))
+            reader = reader.func
+        name = getattr(reader, '__qualname__', '<unknown>')
+        if '<' in name:
+            return None
+        return str(getattr(reader, '__module__', '')) + '.' + name + args
+    
+    @classmethod
+    def cached(cls, files, reader=None, cache_dir='cvr_cache', max_workers=None):
+        """
+        Read CVR files through a binary cache.
+        
+        The cache entry is a directory, named by the SHA-256 hash of the contents of the files,
+        the identity of the reader (with all the arguments of a functools.partial) and the 
+        save() format version, holding the table written by CVRTable.save(). If the 
+        entry exists, the table is memory-mapped from it; otherwise the files are read with
+        CVRTable.from_files() and the table is saved to the cache before it is returned.
+        Changing any of the source files changes the hash, so a stale entry is never used.
+        A reader that cannot be identified (see reader_tag) is not cached: the files are read
+        with CVRTable.from_files().
+        
+        Parameters:
+        -----------
+        files : string or list of strings
+            the files to read
+        reader : callable
+            maps a filename to a CVRTable; see CVRTable.from_files. Default: CVRTable.from_raire
+        cache_dir : string
+            directory that holds the cache entries
+        max_workers : int
+            number of worker processes for parsing; see CVRTable.from_files
+            
+        Returns:
+        --------
+        CVRTable
+        """
+        files = [files] if isinstance(files, (str, os.PathLike)) else list(files)
+        reader = CVRTable.from_raire if reader is None else reader
+        tag = CVRTable.reader_tag(reader)
+        if tag is None:
+            return CVRTable.from_files(files, reader=reader, max_workers=max_workers)
+        tag = 'format {}\0'.format(CVRTable.SAVE_FORMAT) + tag
+        entry = os.path.join(cache_dir, CVRTable.source_hash(files, tag=tag))
+        if not os.path.exists(os.path.join(entry, 'index.json')):
+            table = CVRTable.from_files(files, reader=reader, max_workers=max_workers)
+            tmp = entry + '.tmp{}'.format(os.getpid())
+            table.save(tmp)
+            try:
+                os.replace(tmp, entry)
+            except OSError:  # another process filled the entry first
+                shutil.rmtree(tmp, ignore_errors=True)
+        return CVRTable.load(entry)
+    
+    @classmethod
+    def from_cvrs(cls, cvr_list):
+        """
+        Build a CVRTable from an iterable of CVR objects. 
+        
+        Duplicated ids are merged as in CVR.merge_cvrs. 
+        
+        Parameters:
+        -----------
+        cvr_list : iterable of CVR objects
+        
+        Returns:
+        --------
+        CVRTable
+        """
+        builder = _CVRTableBuilder()
+        for c in cvr_list:
+            builder.add(c.id, c.votes, c.phantom)
+        return builder.build()
+
+
+IntegralState = namedtuple('IntegralState', 'coefficients, log_scale, integrals')
+RunLengthSample = namedtuple('RunLengthSample', 'values, lengths')
+
 class TestNonnegMean:
     r"""Tests of the hypothesis that the mean of a non-negative population is less than
         a threshold t.
@@ -796,12 +1612,184 @@ class TestNonnegMean:
             Wald SPRT with replacement (only for binary-valued populations)
             Wald SPRT without replacement (only for binary-valued populations)
             Kaplan's martingale (KMart)        
+        
+        Every test takes the keyword argument `running`. If running == True, the test returns 
+        the array of p-values for every prefix of the sample, x[:1], x[:2], ..., x[:len(x)],
+        computed in one pass, instead of the p-value for the whole sample. 
+        first_crossing() finds the first prefix whose p-value is at most alpha.
+        
+        The tests also take a 2-D array x, one sample per row (e.g., the overstatement assorter 
+        values for every assertion in an election), and return a p-value for each row. The 
+        parameters t, g, N and p1 can then be arrays with one value per row.
+        
+        kaplan_markov, kaplan_wald and kaplan_kolmogorov also take a RunLengthSample (see 
+        run_length_encode), in time proportional to the number of runs. With running == True, 
+        they then return the p-values at the end of each run. The other tests raise TypeError
+        for a RunLengthSample.
     """
     
-    TESTS = ['kaplan_markov','kaplan_wald','kaplan_kolmogorov','wald_sprt','kaplan_martingale']
+    TESTS = ['kaplan_markov','kaplan_wald','kaplan_kolmogorov','wald_sprt','kaplan_martingale']
+    RUN_LENGTH_TESTS = ['kaplan_markov','kaplan_wald','kaplan_kolmogorov']
+    
+    @classmethod
+    def _reject_run_lengths(cls, test, x):
+        """
+        RunLengthSample is a tuple, so the tests that do not decode it would read it as a 
+        2-row batch of samples
+        """
+        if isinstance(x, RunLengthSample):
+            raise TypeError(test + " does not take a RunLengthSample")
+    
+    @classmethod
+    def _per_row(cls, v, x):
+        """
+        parameter v as a column that broadcasts against the rows of a 2-D sample x
+        """
+        return np.asarray(v)[..., np.newaxis] if (np.ndim(v) > 0 and np.ndim(x) > 1) else v
+    
+    @classmethod
+    def run_length_encode(cls, x, sample=None):
+        """
+        Run-length encode a sample. In a comparison audit, the overstatement assorter takes only a
+        few distinct values, mostly in long runs of the value for sheets without discrepancies.
+        
+        Parameters:
+        -----------
+        x : array-like
+            the values, in the order they were drawn
+        sample : RunLengthSample
+            optional encoded sample (e.g., from earlier rounds) to which x is appended
+        
+        Returns:
+        --------
+        RunLengthSample : the value of each run and its length. The sample is 
+            np.repeat(values, lengths)
+        """
+        x = np.asarray(x, dtype=float)
+        starts = np.flatnonzero(np.concatenate(([True], x[1:] != x[:-1])))[:len(x)]
+        values = x[starts]
+        lengths = np.diff(np.append(starts, len(x)))
+        if sample is not None and len(sample.values) > 0:
+            if len(values) > 0 and values[0] == sample.values[-1]:
+                lengths[0] += sample.lengths[-1]
+                sample = RunLengthSample(sample.values[:-1], sample.lengths[:-1])
+            values = np.concatenate((sample.values, values))
+            lengths = np.concatenate((sample.lengths, lengths))
+        return RunLengthSample(values, lengths)
+    
+    @classmethod
+    def _runs_p_value(cls, log_mart, random_order, running):
+        """
+        p-value from the log of the martingale at the end of each run. Within a run, the log 
+        martingale is monotone, so its running maximum is attained at the end of a run, unless it
+        is below zero, where the p-value is 1 anyway.
+        """
+        if random_order:
+            log_mart = np.maximum.accumulate(log_mart)
+        p = np.exp(-np.maximum(log_mart, 0))
+        if running:
+            return p
+        return p[-1] if len(p) > 0 else 1.0
+    
+    @classmethod
+    def _kaplan_kolmogorov_runs(cls, sample, N, t, g, random_order, running):
+        """
+        kaplan_kolmogorov for a RunLengthSample. For draw j = j0+i in a run with value v, the factor is
+        w(N-j)/(Q-iw), with w = v+g and Q = N(t+g) minus the sample total before the run, so the 
+        product of the factors over a run is a ratio of gamma functions, and the factors are all
+        above 1 or all below 1.
+        """
+        values, lengths = np.asarray(sample.values, dtype=float), np.asarray(sample.lengths)
+        assert np.all(values >= 0),     'Negative value in a nonnegative population!'
+        assert np.sum(lengths) <= N,    'Sample size is larger than the population!'
+        assert N > 0,                   'Population size not positive!'
+        assert N == int(N),             'Non-integer population size!'
+        split = len(values) > 0 and lengths[0] > 1
+        if split: # the first draw has its own factor and does not count in the sample total
+            values = np.concatenate((values[:1], values))
+            lengths = np.concatenate(([1, lengths[0]-1], lengths[1:]))
+        w = values + g
+        j0 = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        Q = N*(t+g) - np.concatenate(([0.0, 0.0], np.cumsum((lengths*w)[1:-1])))[:len(w)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # number of draws in each run before the denominator is no longer positive
+            m = np.where(Q > 0, np.minimum(lengths, np.ceil(Q/w)), 0).astype(int)
+            inc = gammaln(N-j0+1) - gammaln(N-j0-m+1) - gammaln(Q/w+1) + gammaln(Q/w-m+1)
+            inc[m == 0] = 0
+            inc[w == 0] = -np.inf 
+            if len(w) > 0:
+                inc[0] = np.log((values[0]+g)/(t+g)) if t > 0 else 0
+        log_mart = np.cumsum(inc)
+        stop = np.flatnonzero((m < lengths) | (w == 0))
+        stop = stop[stop > 0]
+        if len(stop) > 0 and w[stop[0]] > 0 and log_mart[stop[0]-1] > -np.inf:
+            k = stop[0]
+            # the martingale is infinite from draw m[k] of run k, and negative from the next
+            # draw (or draw m[k], if the denominator is already negative), when it is frozen 
+            if Q[k] - m[k]*w[k] == 0:
+                log_mart[k:] = np.inf
+            else:
+                log_mart[k+1:] = log_mart[k] if random_order else np.inf
+                log_mart[k] = log_mart[k] if random_order else np.inf
+        p = cls._runs_p_value(log_mart, random_order, running)
+        return p[1:] if (running and split) else p
+
+    @classmethod
+    def first_crossing(cls, p, alpha):
+        """
+        Index of the first element of a sequence of p-values that is at most alpha.
+        
+        Parameters:
+        -----------
+        p : array-like
+            running p-values, e.g., from a test called with running=True
+        alpha : double
+            significance level
+        
+        Returns:
+        --------
+        index : int
+            the first index j with p[j] <= alpha, so the stopping time is a sample of size j+1; 
+            None if the sequence never crosses alpha
+        """
+        crossed = np.flatnonzero(np.asarray(p) <= alpha)
+        return int(crossed[0]) if len(crossed) else None
+    
+    @classmethod
+    def p_value(cls, test, x, running=False, **kwargs):
+        """
+        p-value (or running p-values) of the sample x for one of the TESTS.
+        Returns just the p-value for kaplan_martingale, which also returns the martingale.
+        """
+        if test not in cls.RUN_LENGTH_TESTS:
+            cls._reject_run_lengths(test, x)
+        p = getattr(cls, test)(x, running=running, **kwargs)
+        return p[0] if (test == 'kaplan_martingale' and not running) else p
     
     @classmethod
-    def wald_sprt(cls, x, N, t = 1/2, p1=1, random_order = True):
+    def risk_function(cls, test, **kwargs):
+        """
+        Fix the parameters of one of the TESTS to make a risk function.
+        
+        Parameters:
+        -----------
+        test : string
+            one of the TESTS
+        kwargs : 
+            the parameters of the test other than the sample, e.g., N, t, g
+        
+        Returns:
+        --------
+        risk_function : callable
+            risk_function(x) is the p-value for the sample x; risk_function(x, running=True)
+            is the array of running p-values. The result is a functools.partial, so it can be 
+            pickled, and the test and its parameters can be read from it.
+        """
+        assert test in cls.TESTS, "unknown test " + str(test)
+        return functools.partial(cls.p_value, test, **kwargs)
+    
+    @classmethod
+    def wald_sprt(cls, x, N, t = 1/2, p1=1, random_order = True, running = False):
         """
         Finds the p value for the hypothesis that the population 
         mean is less than or equal to t against the alternative that it is p1,
@@ -824,30 +1812,45 @@ class TestNonnegMean:
         random_order : Boolean
             if the data are in random order, setting this to True can improve the power.
             If the data are not in random order, set to False
+        running : Boolean
+            if True, return the p-values for every prefix of x
+        """
+        cls._reject_run_lengths('wald_sprt', x)
+        x = np.asarray(x)
+        N, t, p1 = cls._per_row(N, x), cls._per_row(t, x), cls._per_row(p1, x)
+        log_terms = cls._wald_sprt_log_terms(x, N, t, p1)
+        with np.errstate(invalid='ignore'):
+            log_mart = np.cumsum(log_terms, axis=-1)
+        if running:
+            return np.exp(-np.maximum.accumulate(log_mart, axis=-1)) if random_order \
+                   else np.exp(-log_mart)
+        if x.shape[-1] == 0:
+            return np.ones(x.shape[:-1]) if x.ndim > 1 else 1.0
+        return np.exp(-np.max(log_mart, axis=-1)) if random_order else np.exp(-log_mart[..., -1])
+
+    @classmethod
+    def _wald_sprt_log_terms(cls, x, N, t, p1, k0=0, A0=0):
         """
-        if any(xx not in [0,1] for xx in x):
+        log of the factors of the SPRT martingale, for draws k0, k0+1, ... of a sample that
+        had A0 ones in its first k0 draws
+        """
+        if np.any((x != 0) & (x != 1)):
             raise ValueError("Data must be binary")
-        terms = np.ones(len(x))
-        if np.isfinite(N):
-            A = np.cumsum(np.insert(x, 0, 0)) # so that cumsum does the right thing
-            for k in range(len(x)):
-                if x[k] == 1.0:
-                    if (N*t - A[k]) > 0:
-                        terms[k] = np.max([N*p1 - A[k], 0])/(N*t - A[k])
-                    else:
-                        terms[k] = np.inf
-                else:
-                    if (N*(1-t) - k + 1 + A[k]) > 0:
-                        terms[k] = np.max([(N*(1-p1) - k + 1 + A[k]), 0])/(N*(1-t) - k + 1 + A[k])
-                    else:
-                        terms[k] = np.inf
-        else:
-            terms[x==0] = (1-p1)/(1-t)
-            terms[x==1] = p1/t
-        return 1/np.max(np.cumprod(terms)) if random_order else 1/np.prod(terms)
+        ones = (x == 1)
+        finite = np.isfinite(N)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_terms = np.where(ones, np.log(p1/t), np.log((1-p1)/(1-t)))
+            if np.any(finite):
+                k = k0 + np.arange(x.shape[-1])
+                A = A0 + np.cumsum(x, axis=-1) - x # number of ones before draw k
+                num = np.where(ones, N*p1 - A, N*(1-p1) - k + 1 + A)
+                den = np.where(ones, N*t - A, N*(1-t) - k + 1 + A)
+                log_terms = np.where(finite, np.where(den > 0, \
+                            np.log(np.maximum(num, 0)) - np.log(den), np.inf), log_terms)
+        return log_terms
 
     @classmethod
-    def kaplan_markov(cls, x, t=1/2, g=0, random_order=True):
+    def kaplan_markov(cls, x, t=1/2, g=0, random_order=True, running=False):
         """
         Kaplan-Markov p-value for the hypothesis that the sample x is drawn IID from a population
         with mean t against the alternative that the mean is less than t.
@@ -861,7 +1864,7 @@ class TestNonnegMean:
         
         Parameters:
         -----------
-        x : array-like
+        x : array-like or RunLengthSample
             the sample
         t : double
             the null value of the mean
@@ -870,18 +1873,33 @@ class TestNonnegMean:
         random_order : Boolean
             if the sample is in random order, it is legitimate to stop early, which 
             can yield a more powerful test. See above.
+        running : Boolean
+            if True, return the p-values for every prefix of x
         
         Returns:
         --------
         p-value
         
         """       
-        if any(x < 0):
+        if isinstance(x, RunLengthSample):
+            if np.any(np.asarray(x.values) < 0):
+                raise ValueError('Negative value in sample from a nonnegative population.')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_mart = np.cumsum(x.lengths*(np.log(x.values+g) - np.log(t+g)))
+            return cls._runs_p_value(log_mart, random_order, running)
+        x = np.asarray(x)
+        if np.any(x < 0):
             raise ValueError('Negative value in sample from a nonnegative population.')
-        return np.min([1, np.min(np.cumprod((t+g)/(x+g))) if random_order else np.prod((t+g)/(x+g))])
+        t, g = cls._per_row(t, x), cls._per_row(g, x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_p = np.cumsum(np.log(t+g) - np.log(x+g), axis=-1)
+        if running:
+            return np.exp(np.minimum(0, np.minimum.accumulate(log_p, axis=-1) if random_order \
+                                        else log_p))
+        return np.exp(np.minimum(0, np.min(log_p, axis=-1) if random_order else log_p[..., -1]))
 
     @classmethod
-    def kaplan_wald(cls, x, t=1/2, g=0, random_order=True):
+    def kaplan_wald(cls, x, t=1/2, g=0, random_order=True, running=False):
         """
         Kaplan-Wald p-value for the hypothesis that the sample x is drawn IID from a population
         with mean t against the alternative that the mean is less than t.
@@ -895,7 +1913,7 @@ class TestNonnegMean:
 
         Parameters:
         -----------
-        x : array-like
+        x : array-like or RunLengthSample
             the sample
         t : double
             the null value of the mean
@@ -904,21 +1922,35 @@ class TestNonnegMean:
         random_order : Boolean
             if the sample is in random order, it is legitimate to stop early, which 
             can yield a more powerful test. See above.
+        running : Boolean
+            if True, return the p-values for every prefix of x
 
         Returns:
         --------
         p-value
        
         """       
-        if g < 0:
+        if np.any(np.asarray(g) < 0):
             raise ValueError('g cannot be negative')
-        if any(x < 0):
+        if isinstance(x, RunLengthSample):
+            if np.any(np.asarray(x.values) < 0):
+                raise ValueError('Negative value in sample from a nonnegative population.')
+            with np.errstate(divide='ignore'):
+                log_mart = np.cumsum(x.lengths*np.log((1-g)*np.asarray(x.values)/t + g))
+            return cls._runs_p_value(log_mart, random_order, running)
+        x = np.asarray(x)
+        if np.any(x < 0):
             raise ValueError('Negative value in sample from a nonnegative population.')
-        return np.min([1, 1/np.max(np.cumprod((1-g)*x/t + g)) if random_order \
-                       else 1/np.prod((1-g)*x/t + g)])
+        t, g = cls._per_row(t, x), cls._per_row(g, x)
+        with np.errstate(divide='ignore'):
+            log_mart = np.cumsum(np.log((1-g)*x/t + g), axis=-1)
+        if running:
+            return np.exp(-np.maximum(0, np.maximum.accumulate(log_mart, axis=-1) if random_order \
+                                         else log_mart))
+        return np.exp(-np.maximum(0, np.max(log_mart, axis=-1) if random_order else log_mart[..., -1]))
     
     @classmethod
-    def kaplan_kolmogorov(cls, x, N, t=1/2, g=0, random_order = True):
+    def kaplan_kolmogorov(cls, x, N, t=1/2, g=0, random_order = True, running = False):
         '''
         p-value for the hypothesis that the mean of a nonnegative population with N
         elements is t. The alternative is that the mean is less than t.
@@ -931,7 +1963,7 @@ class TestNonnegMean:
         
         Parameters:
         -----------
-        x : list
+        x : list or RunLengthSample
             observations
         N : int
             population size
@@ -939,26 +1971,57 @@ class TestNonnegMean:
             null value of the population mean
         g : double in [0, 1)
             "padding" to protect against zeros
+        running : Boolean
+            if True, return the p-values for every prefix of x
         '''
-        x = np.array(x)
-        assert all(x >=0),  'Negative value in a nonnegative population!'
-        assert len(x) <= N, 'Sample size is larger than the population!'
-        assert N > 0,       'Population size not positive!'
-        assert N == int(N), 'Non-integer population size!'
-        
-        sample_total = 0.0
-        mart = (x[0]+g)/(t+g) if t > 0 else 1
-        mart_max = mart
-        for j in range(1, len(x)):
-            mart *= (x[j]+g)*(1-j/N)/(t+g - (1/N)*sample_total)
-            if mart < 0:
-                mart = np.inf
-                break
+        if isinstance(x, RunLengthSample):
+            return cls._kaplan_kolmogorov_runs(x, N, t, g, random_order, running)
+        x = np.array(x, dtype=float)
+        assert np.all(x >=0),               'Negative value in a nonnegative population!'
+        assert np.all(x.shape[-1] <= N),    'Sample size is larger than the population!'
+        assert np.all(np.asarray(N) > 0),   'Population size not positive!'
+        assert np.all(N == np.floor(N)),    'Non-integer population size!'
+        
+        N, t, g = cls._per_row(N, x), cls._per_row(t, x), cls._per_row(g, x)
+        terms = cls._kolmogorov_terms(x, N, t, g)[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_mart = np.cumsum(np.log(np.abs(terms)), axis=-1)
+        # the martingale goes negative at the first negative term, unless it is already zero 
+        # (or undefined): from there on it is set to infinity, but does not enter the running maximum
+        nonpos = ~(terms > 0)
+        first = np.argmax(nonpos, axis=-1)[..., np.newaxis]
+        negative = np.any(nonpos, axis=-1, keepdims=True) & \
+                   (np.take_along_axis(terms, first, axis=-1) < 0)
+        log_mart[negative & (np.arange(x.shape[-1]) >= first)] = -np.inf if random_order else np.inf
+        if random_order:
+            log_mart = np.maximum.accumulate(log_mart, axis=-1)
+        p_running = np.exp(-np.maximum(log_mart, 0))
+        if running:
+            return p_running
+        return p_running[..., -1]
+
+    @classmethod
+    def _kolmogorov_terms(cls, x, N, t, g, j0=0, sample_total=0.0):
+        """
+        factors of the Kaplan-Kolmogorov martingale for draws j0, j0+1, ... of a sample, where 
+        sample_total is the total of x+g over draws 1, ..., j0-1 (the first draw is not included).
+        Returns the factors and the sample total including the new draws.
+        """
+        n = x.shape[-1]
+        j = j0 + np.arange(n)
+        zeros = np.zeros(x.shape[:-1] + (2,))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if j0 == 0:
+                totals = np.concatenate((zeros, np.cumsum(x[..., 1:-1]+g, axis=-1)), axis=-1)[..., :n]
             else:
-                sample_total += x[j]+g
-            mart_max = max(mart, mart_max)
-        p = min((1/mart_max if random_order else 1/mart),1)
-        return p 
+                totals = sample_total + np.concatenate((zeros[..., :1], \
+                                                        np.cumsum(x[..., :-1]+g, axis=-1)), axis=-1)
+            terms = (x+g)*(1-j/N)/(t+g - (1/N)*totals)
+            if j0 == 0 and n > 0:
+                terms[..., :1] = np.where(np.asarray(t) > 0, (x[..., :1]+g)/(t+g), 1)
+        if n > 0 and j0+n > 1:
+            sample_total = (totals[..., -1:] + x[..., -1:] + g)[..., 0]
+        return terms, sample_total
 
     @classmethod
     def integral_from_roots(cls, c, maximal=True):
@@ -978,24 +2041,121 @@ class TestNonnegMean:
         ------
         the integral or maximum integral and the vector of nested integrals
         '''
-        n = len(c)
-        a = np.zeros((n+1,n+1))
-        a[0,0]=1
-        for k in np.arange(n):
-            for j in np.arange(n+1):
-                a[k+1,j] = -c[k]*((k+1-j)/(k+1))*a[k,j]
-                a[k+1,j] += 0 if j==0 else (1-c[k])*(j/(k+1))*a[k,j-1]
-        integrals = np.zeros(n)
-        for k in np.arange(1,n+1):
-            integrals[k-1] = np.sum(a[k,:])/(k+1)
+        state = cls.extend_integrals(c)
         if maximal:
-            integral = np.max(integrals[1:])
+            integral = np.max(state.integrals[1:])
         else:
-            integral = np.sum(a[n,:])/(n+1)
-        return integral, integrals
+            integral = state.integrals[-1] if len(c) > 0 else 1.0
+        return integral, state.integrals
+
+    @classmethod
+    def extend_integrals(cls, c, state=None):
+        '''
+        Append the roots c to the recursion of integral_from_roots.
+        
+        The recursion only needs the coefficients of the polynomial of the current degree, so
+        each new root updates one row of coefficients in place: memory is linear in the number 
+        of roots, and integrals for a growing sample can be extended without starting over.
+    
+        Parameters:
+        -----------
+        c : array of roots to append
+        state : IntegralState
+            the result of a previous call, or None to start from the empty product
+    
+        Returns
+        ------
+        IntegralState : the coefficients for all the roots so far, scaled by exp(-log_scale), and 
+            the vector of nested integrals
+        '''
+        c = np.asarray(c, dtype=float)
+        if state is None:
+            state = IntegralState(np.ones(1), 0.0, np.zeros(0))
+        a, log_scale, sums, log_scales = cls._bernstein_products(-c, 1-c, state.coefficients, \
+                                                                 state.log_scale)
+        degree = np.arange(len(state.coefficients), len(a))
+        with np.errstate(over='ignore', invalid='ignore'):
+            integrals = sums*np.exp(log_scales)/(degree+1)
+        return IntegralState(a, log_scale, np.concatenate((state.integrals, integrals)))
+
+    @classmethod
+    def _bernstein_products(cls, alpha, beta, coefficients, log_scale):
+        '''
+        Multiply a polynomial in Bernstein form by the linear factors alpha_j*(1-u) + beta_j*u, one
+        at a time. The coefficients are rescaled to a maximum absolute value of 1 after every factor,
+        and the logarithm of the scale is carried separately, so they neither overflow nor underflow.
+        
+        The integral over [0, 1] of a polynomial of degree k in Bernstein form is the sum of its
+        coefficients divided by k+1.
+        
+        Parameters:
+        -----------
+        alpha, beta : arrays
+            the factors
+        coefficients : array
+            Bernstein coefficients of the polynomial to start from, divided by exp(log_scale)
+        log_scale : double
+    
+        Returns
+        ------
+        a : array
+            coefficients of the product of all the factors, divided by exp(log_scale)
+        log_scale : double
+        sums : array
+            sums[i]*exp(log_scales[i]) is the sum of the coefficients after the ith factor 
+        log_scales : array
+        '''
+        k0 = len(coefficients)-1
+        n = k0 + len(alpha)
+        a = np.zeros(n+1)
+        a[:k0+1] = coefficients
+        j = np.arange(n+1)
+        sums = np.zeros(len(alpha))
+        log_scales = np.zeros(len(alpha))
+        for i, (al, be) in enumerate(zip(alpha, beta)):
+            k = k0 + i
+            a[1:k+2] = al*((k+1-j[1:k+2])/(k+1))*a[1:k+2] + be*(j[1:k+2]/(k+1))*a[:k+1]
+            a[0] *= al
+            scale = np.max(np.abs(a[:k+2]))
+            if 0 < scale < np.inf:
+                a[:k+2] /= scale
+                log_scale += np.log(scale)
+            sums[i] = np.sum(a[:k+2])
+            log_scales[i] = log_scale
+        return a, log_scale, sums, log_scales
+
+    @classmethod
+    def _kaplan_impossible(cls, x, t_minus_Stilde):
+        r"""
+        Is the null impossible once x_j is drawn? True where t - \tilde{S}_{j-1} < 0 (the sample
+        total already exceeds the hypothesized population total), or where it is 0 and x_j > 0
+        (the rest of the population would have to be all zeros).
+        """
+        return (t_minus_Stilde < 0) | ((t_minus_Stilde == 0) & (np.asarray(x) > 0))
+
+    @classmethod
+    def _kaplan_log_martingale(cls, x, N, t_minus_Stilde, coefficients=None, log_scale=0.0, j0=0):
+        r'''
+        log of the KMart martingale \int_0^1 \prod_{j \le k} (1 + u(y_j - 1)) du for every prefix of x,
+        with y_j = x_j (1-(j-1)/N)/(t - \tilde{S}_{j-1}). Each factor is (1-u) + u y_j in Bernstein
+        form, so all the coefficients are nonnegative. The draws must not make the null 
+        impossible (see _kaplan_impossible); y_j = 0 where x_j = 0.
+        
+        To continue a sample, pass the coefficients and log_scale returned for the first j0 draws.
+        Returns the log martingale, the coefficients and the log_scale.
+        '''
+        jtilde = 1 - (j0 + np.arange(len(x)))/N
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.where(np.asarray(x) > 0, np.multiply(x, np.divide(jtilde, t_minus_Stilde)), 0)
+        coefficients = np.ones(1) if coefficients is None else coefficients
+        a, log_scale, sums, log_scales = cls._bernstein_products(np.ones(len(x)), y, coefficients, \
+                                                                 log_scale)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_mart = np.log(sums) + log_scales - np.log(j0 + np.arange(2, len(x)+2))
+        return log_mart, a, log_scale
 
     @classmethod
-    def kaplan_martingale(cls, x, N, t=1/2, random_order = True):
+    def kaplan_martingale(cls, x, N, t=1/2, random_order = True, running = False):
         """
         p-value for the hypothesis that the mean of a nonnegative population with 
         N elements is t, based on a result of Kaplan, computed with a recursive 
@@ -1019,6 +2179,8 @@ class TestNonnegMean:
             the hypothesized population mean
         random_order : boolean
             is the sample in random order?
+        running : boolean
+            if True, return only the array of p-values for every prefix of x
             
         Returns: 
         -------  
@@ -1028,7 +2190,13 @@ class TestNonnegMean:
             martingale as elements are added to the sample
           
         """
+        cls._reject_run_lengths('kaplan_martingale', x)
         x = np.array(x)
+        if x.ndim > 1: # one sample per row
+            rows = [cls.kaplan_martingale(xx, NN, tt, random_order, running) for xx, NN, tt in \
+                    zip(x, np.broadcast_to(N, x.shape[:-1]), np.broadcast_to(t, x.shape[:-1]))]
+            return np.array(rows) if running else \
+                   (np.array([r[0] for r in rows]), np.array([r[1] for r in rows]))
         assert all(x >=0),  'Negative value in a nonnegative population!'
         assert len(x) <= N, 'Sample size is larger than the population!'
         assert N > 0,       'Population size not positive!'
@@ -1036,26 +2204,147 @@ class TestNonnegMean:
             assert N == int(N), 'Non-integer population size!'
         Stilde = (np.insert(np.cumsum(x),0,0)/N)[0:len(x)] # \tilde{S}_{j-1}
         t_minus_Stilde = t - Stilde
-        mart_max = 1
-        mart_vec = np.ones_like(x, dtype=np.float)
-        if any(t_minus_Stilde < 0): # sample total exceeds hypothesized population total 
-            mart_max = np.inf
+        if running:
+            return TestNonnegMean._kaplan_martingale_running(x, N, t, random_order, t_minus_Stilde)
+        log_mart_max = 0
+        mart_vec = np.ones_like(x, dtype=float)
+        if any(TestNonnegMean._kaplan_impossible(x, t_minus_Stilde)): # null is impossible
+            log_mart_max = np.inf
         elif np.mean(x) <= t: # sample mean does not exceed hypothesized population mean
-            mart_max = 1
+            log_mart_max = 0
         else: 
-            jtilde = 1 - np.array(list(range(len(x))))/N
-            c = np.multiply(x, np.divide(jtilde, t_minus_Stilde))-1 
-            r = -np.array([1/cc for cc in c[0:len(x)+1] if cc != 0]) # roots
-            Y_norm = np.cumprod(np.array([cc for cc in c[0:len(x)+1] if cc != 0])) # mult constant
-            integral, integrals = TestNonnegMean.integral_from_roots(r, maximal = False)
-            mart_vec = np.multiply(Y_norm,integrals)
-            mart_max = max(mart_vec) if random_order else mart_vec[-1]
-        p = min(1/mart_max,1)
+            log_mart = TestNonnegMean._kaplan_log_martingale(x, N, t_minus_Stilde)[0]
+            with np.errstate(over='ignore'):
+                mart_vec = np.exp(log_mart)
+            log_mart_max = max(log_mart) if random_order else log_mart[-1]
+        p = np.exp(-max(log_mart_max, 0))
         return p, mart_vec                  
+    
+    @classmethod
+    def _kaplan_martingale_running(cls, x, N, t, random_order, t_minus_Stilde):
+        """
+        running p-values for kaplan_martingale, with its rules applied to every prefix of x:
+        p = 0 once the sample total exceeds the hypothesized population total; p = 1 while the 
+        sample mean does not exceed t; otherwise 1/(max of the martingale)
+        """
+        n = len(x)
+        p = np.ones(n)
+        over = np.cumsum(TestNonnegMean._kaplan_impossible(x, t_minus_Stilde)) > 0 # null is impossible
+        m = n if not over.any() else int(np.argmax(over))
+        if m > 0:
+            log_mart = TestNonnegMean._kaplan_log_martingale(x[:m], N, t_minus_Stilde[:m])[0]
+            if random_order:
+                log_mart = np.maximum.accumulate(log_mart)
+            p[:m] = np.exp(-np.maximum(log_mart, 0))
+            p[:m][np.cumsum(x[:m])/np.arange(1, m+1) <= t] = 1
+        p[m:] = 0
+        return p
+        
+    @classmethod
+    def simulate_stopping_times(cls, risk_function, draw, reps, N, alpha, seed=1234567890, \
+                                block=256, max_cells=10**7):
+        """
+        Stopping times for reps simulated samples, from the running p-values of many replicates
+        at once.
+        
+        The samples are made from a (reps x n) array of uniform random numbers. Only the first n
+        columns are generated, starting with n = block and doubling n for the replicates that 
+        have not yet stopped. The array is generated in (block x block) tiles, each from its own 
+        seed derived from seed and the position of the tile, so the results do not depend on
+        max_cells or on the order in which the replicates are processed.
+        
+        Parameters:
+        -----------
+        risk_function : callable
+            risk_function(x, running=True) returns the running p-values of every row of the 2-D
+            array x, as the TESTS do
+        draw : callable
+            draw(u) maps an array of uniform random numbers in [0, 1) to sample values, elementwise
+        reps : int
+            number of replicates
+        N : int
+            population size, or np.inf
+        alpha : double
+            significance level
+        seed : int
+            seed for the simulations
+        block : int
+            side of the tiles of random numbers
+        max_cells : int
+            largest number of sample values to evaluate at once
+        
+        Returns:
+        --------
+        sams : array of ints
+            the stopping time of every replicate; N+1 if the p-value does not reach alpha
+        """
+        def uniforms(rows, n):
+            u = np.empty((len(rows), n))
+            for rb in np.unique(rows // block):
+                mine = (rows // block) == rb
+                for cb in range(-(-n // block)):
+                    tile = np.random.default_rng([seed, rb, cb]).random((block, block))
+                    u[mine, cb*block:(cb+1)*block] = tile[rows[mine] % block][:, :n-cb*block]
+            return u
+        
+        sams = np.full(int(reps), N+1, dtype=float)
+        rows = np.arange(int(reps))
+        n = int(min(block, N))
+        while len(rows) > 0:
+            batch = max(1, int(max_cells // n))
+            going = []
+            for start in range(0, len(rows), batch):
+                r = rows[start:start+batch]
+                crossed = np.atleast_2d(risk_function(draw(uniforms(r, n)), running=True)) <= alpha
+                stopped = crossed.any(axis=1)
+                sams[r[stopped]] = np.argmax(crossed[stopped], axis=1) + 1
+                going.append(r[~stopped])
+            rows = np.concatenate(going)
+            if n >= N:
+                break
+            n = int(min(2*n, N))
+        return sams
+
+    @classmethod
+    def stopping_time(cls, risk_function, draw, N, alpha, start=64):
+        """
+        Sample size at which the p-value first falls to alpha or below, found from the running
+        p-values of prefixes of the sample of doubling length, rather than by calling 
+        risk_function once for every sample size.
+        
+        Parameters:
+        -----------
+        risk_function : callable
+            risk_function(x, running=True) returns the running p-values of the sample x
+        draw : callable
+            draw(n) returns the first n elements of the sample. The first n elements
+            must not depend on n.
+        N : int
+            population size, or np.inf
+        alpha : double
+            significance level
+        start : int
+            length of the first prefix examined
         
+        Returns:
+        --------
+        j : int
+            the smallest j such that the p-value of the first j elements is at most alpha; 
+            N+1 if there is no such j <= N
+        """
+        n = int(min(N, start))
+        while True:
+            j = cls.first_crossing(risk_function(draw(n), running=True), alpha)
+            if j is not None:
+                return j+1
+            if n >= N:
+                return N+1
+            n = int(min(2*n, N))
+    
     @classmethod
     def initial_sample_size(cls, risk_function, N, margin, error_rate, alpha=0.05, t=1/2, reps=None,\
-                            bias_up = True, quantile=0.5, seed=1234567890):
+                            bias_up = True, quantile=0.5, seed=1234567890, running=False, \
+                            monotone=True, max_cells=10**7):
         """
         Estimate the sample size needed to reject the null hypothesis that the population 
         mean is <=t at significance level alpha, for the specified risk function, on the 
@@ -1073,6 +2362,10 @@ class TestNonnegMean:
             with a discrepancy in the first item if bias_up is true, then including an additional discrepancy after 
             every int(1/error_rate) items in the sample. "Frontloading" the errors (bias_up == True) should make this
             _slightly_ conservative on average
+            
+            If monotone is True, the sample size is found by doubling the sample until the p-value 
+            is at most alpha, then bisecting, which takes O(log n) calls to risk_function.
+            If monotone is False, the sample is grown one item at a time.
         
         
         Parameters:
@@ -1100,6 +2393,20 @@ class TestNonnegMean:
             If reps is None, quantile is not used
         seed : int
             if reps is not none, use this value as the seed for simulations.
+        running : boolean
+            if True, risk_function must accept the keyword argument `running` (as the TESTS do, 
+            and as functions made by TestNonnegMean.risk_function() do), and the sample size is 
+            found from running p-values (see stopping_time) instead of by re-running 
+            risk_function on every prefix of the sample. If reps is not None, risk_function must 
+            also accept a 2-D sample, one replicate per row, and the replicates are simulated 
+            many at a time by simulate_stopping_times.
+        monotone : boolean
+            if reps is None and running is False, is the p-value of the deterministic sample 
+            non-increasing in the sample size (as it is for the TESTS with random_order=True)? If 
+            so, the sample size is found by bisection. Set to False for other risk functions.
+        max_cells : int
+            if reps is not None and running is True, the largest number of sample values to 
+            simulate at once
             
         Returns:
         --------
@@ -1113,7 +2420,30 @@ class TestNonnegMean:
         assert margin > 0
         clean = 1/(2-margin)
         one_vote_over = 0.5/(2-margin)
-        if reps is None:
+        offset = 0 if bias_up else 1
+        def pattern(n):
+            x = clean*np.ones(n)
+            x[(np.arange(n)+offset) % int(1/error_rate) == 0] = one_vote_over
+            return x
+        if reps is None and running:
+            sam_size = TestNonnegMean.stopping_time(risk_function, pattern, N, alpha)
+        elif reps is None and monotone:
+            lo, hi = 0, 1 # the p-value for a sample of size lo exceeds alpha
+            x = pattern(hi)
+            while risk_function(x) > alpha and hi < N:
+                lo, hi = hi, min(2*hi, N)
+                x = pattern(hi)
+            if risk_function(x) > alpha:
+                sam_size = N+1
+            else:
+                while hi - lo > 1:
+                    mid = (lo + hi)//2
+                    if risk_function(x[:mid]) <= alpha:
+                        hi = mid
+                    else:
+                        lo = mid
+                sam_size = hi
+        elif reps is None:
             offset = 0 if bias_up else 1                
             p = 1
             j = 0
@@ -1124,6 +2454,11 @@ class TestNonnegMean:
                     x[k] = one_vote_over if (k+offset) % int(1/error_rate) == 0 else x[k]                   
                 p = risk_function(x)
             sam_size = j
+        elif running:
+            draw = lambda u: np.where(u <= error_rate, one_vote_over, clean)
+            sams = TestNonnegMean.simulate_stopping_times(risk_function, draw, reps, N, alpha, \
+                                                          seed=seed, max_cells=max_cells)
+            sam_size = np.quantile(sams, quantile)
         else:
             prng = np.random.RandomState(1234567890)  # use the Mersenne Twister for speed
             sams = np.zeros(int(reps))
@@ -1140,8 +2475,248 @@ class TestNonnegMean:
                 sams[r] = j
             sam_size = np.quantile(sams, quantile)
         return sam_size
-          
+
+
+class RunningTest:
+    '''
+    State of one of the TestNonnegMean.TESTS for a sample that grows, so that the p-value can be 
+    updated as new values arrive instead of being recomputed from the whole sample.
+    
+    The state is the number of draws so far, the sample total used by the corrections for sampling
+    without replacement, the log of the martingale and its running maximum. update() takes time
+    proportional to the number of new values, except for kaplan_martingale, which takes time 
+    proportional to the size of the sample for each new value. 
+    
+    After update(x_1), ..., update(x_k), p_value is the p-value of the test applied to the 
+    concatenation of x_1, ..., x_k.
+    '''
+    
+    def __init__(self, test, random_order=True, **kwargs):
+        '''
+        Parameters:
+        -----------
+        test : string
+            one of TestNonnegMean.TESTS
+        random_order : Boolean
+            is the sample in random order? See the tests.
+        kwargs : 
+            the parameters of the test other than the sample, e.g., N, t, g
+        '''
+        assert test in TestNonnegMean.TESTS, "unknown test " + str(test)
+        self.test = test
+        self.random_order = random_order
+        self.kwargs = kwargs
+        self.t = kwargs.get('t', 1/2)
+        self.N = kwargs.get('N', np.inf)
+        self.n = 0
+        self.sample_total = 0.0
+        self.log_mart = 0.0
+        self.log_mart_max = -np.inf
+        self.p_value = 1.0
+        self.stopped = None          # kaplan_kolmogorov and kaplan_martingale: see the tests
+        self.coefficients = np.ones(1) # kaplan_martingale: scaled Bernstein coefficients
+        self.log_scale = 0.0
+        
+    def __str__(self):
+        return str(self.__dict__)
+
+    @classmethod
+    def from_risk_function(cls, risk_function):
+        '''
+        RunningTest for a risk function made by TestNonnegMean.risk_function
+        '''
+        return cls(risk_function.args[0], **risk_function.keywords)
+    
+    def update(self, x):
+        '''
+        Add values to the sample.
+        
+        Parameters:
+        -----------
+        x : double or array-like
+            the new values, in the order they were drawn
+        
+        Returns:
+        --------
+        p_value : double
+            the p-value for the whole sample so far
+        '''
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        if len(x) == 0:
+            return self.p_value
+        if (x < 0).any():
+            raise ValueError('Negative value in sample from a nonnegative population.')
+        assert self.n + len(x) <= self.N, 'Sample size is larger than the population!'
+        if self.test == 'kaplan_martingale':
+            self.p_value = self._update_kaplan_martingale(x)
+        else:
+            log_mart = getattr(self, '_log_' + self.test)(x)
+            self.log_mart = log_mart[-1]
+            self.log_mart_max = np.maximum(self.log_mart_max, log_mart.max())
+            log_m = self.log_mart_max if self.random_order else self.log_mart
+            self.p_value = np.exp(-log_m) if self.test == 'wald_sprt' else np.exp(-max(log_m, 0))
+        self.n += len(x)
+        return self.p_value
+    
+    def _log_kaplan_markov(self, x):
+        g = self.kwargs.get('g', 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.log_mart + np.cumsum(np.log(x+g) - np.log(self.t+g))
+    
+    def _log_kaplan_wald(self, x):
+        g = self.kwargs.get('g', 0)
+        if g < 0:
+            raise ValueError('g cannot be negative')
+        with np.errstate(divide='ignore'):
+            return self.log_mart + np.cumsum(np.log((1-g)*x/self.t + g))
+    
+    def _log_wald_sprt(self, x):
+        log_terms = TestNonnegMean._wald_sprt_log_terms(x, self.N, self.t, self.kwargs.get('p1', 1),\
+                                                        k0=self.n, A0=self.sample_total)
+        self.sample_total += np.sum(x)
+        with np.errstate(invalid='ignore'):
+            return self.log_mart + np.cumsum(log_terms)
+    
+    def _log_kaplan_kolmogorov(self, x):
+        if self.stopped == 'infinite':
+            return np.full(len(x), -np.inf if self.random_order else np.inf)
+        terms, self.sample_total = TestNonnegMean._kolmogorov_terms(x, self.N, self.t, \
+                                   self.kwargs.get('g', 0), j0=self.n, sample_total=self.sample_total)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_mart = self.log_mart + np.cumsum(np.log(np.abs(terms)))
+        nonpos = np.flatnonzero(~(terms > 0))
+        if self.stopped is None and len(nonpos) > 0:
+            self.stopped = 'infinite' if terms[nonpos[0]] < 0 else 'zero'
+            if self.stopped == 'infinite':
+                log_mart[nonpos[0]:] = -np.inf if self.random_order else np.inf
+        return log_mart
+    
+    def _update_kaplan_martingale(self, x):
+        if self.stopped is None:
+            t_minus_Stilde = self.t - (self.sample_total + np.insert(np.cumsum(x), 0, 0)[:-1])/self.N
+            over = np.flatnonzero(TestNonnegMean._kaplan_impossible(x, t_minus_Stilde))
+            m = len(x) if len(over) == 0 else over[0]
+            if m > 0:
+                log_mart, self.coefficients, self.log_scale = TestNonnegMean._kaplan_log_martingale(\
+                        x[:m], self.N, t_minus_Stilde[:m], self.coefficients, self.log_scale, self.n)
+                self.log_mart = log_mart[-1]
+                self.log_mart_max = np.maximum(self.log_mart_max, log_mart.max())
+            if m < len(x): # null is impossible
+                self.stopped = 'infinite'
+        self.sample_total += np.sum(x)
+        if self.stopped == 'infinite':
+            return 0.0
+        if self.sample_total/(self.n + len(x)) <= self.t: # sample mean does not exceed t
+            return 1.0
+        return np.exp(-max(self.log_mart_max if self.random_order else self.log_mart, 0))
+
+
+class SampleSizeCache:
+    """
+    Memo of TestNonnegMean.initial_sample_size(), so that assertions with the same margin, and 
+    repeated planning runs, do not repeat the computation.
+    
+    Entries are keyed by the SHA-256 hash of the risk function (the test and its parameters, 
+    for functions made by TestNonnegMean.risk_function()) and all the arguments of 
+    initial_sample_size other than max_cells, with the defaults filled in. The most recently 
+    used maxsize entries are held in memory; if cache_dir is not None, every entry is also 
+    written there as a small json file, so the sizes survive from one session to the next. 
+    Only risk functions made by TestNonnegMean.risk_function() (or other functools.partial 
+    objects of TestNonnegMean methods) are cached; see key().
+    """
+    
+    def __init__(self, maxsize=1024, cache_dir=None):
+        """
+        Parameters:
+        -----------
+        maxsize : int
+            number of entries to keep in memory
+        cache_dir : string
+            directory for the entries on disk; None to keep them in memory only
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+    
+    @classmethod
+    def key(cls, risk_function, *args, **kwargs):
+        """
+        The cache key for TestNonnegMean.initial_sample_size(risk_function, *args, **kwargs), 
+        or None if risk_function cannot be identified.
+        
+        Only a functools.partial of a TestNonnegMean method (e.g., made by 
+        TestNonnegMean.risk_function()) can be identified: its parameters are all in the partial.
+        Any other function may depend on values it reads from its closure or from globals 
+        (N, g, ...), which can change between sessions without changing its name.
+        """
+        if not isinstance(risk_function, functools.partial) or \
+           getattr(risk_function.func, '__self__', None) is not TestNonnegMean:
+            return None
+        default = lambda v: v.tolist() if isinstance(v, np.ndarray) else repr(v)
+        tag = [risk_function.func.__qualname__, \
+               json.dumps([risk_function.args, risk_function.keywords], sort_keys=True, \
+                          default=default)]
+        params = inspect.signature(TestNonnegMean.initial_sample_size).bind(risk_function, \
+                                                                            *args, **kwargs)
+        params.apply_defaults()
+        params = {k: v for k, v in params.arguments.items() if k not in ('risk_function', 'max_cells')}
+        tag.append(json.dumps(params, sort_keys=True, default=default))
+        return hashlib.sha256('\0'.join(tag).encode('utf-8')).hexdigest()
+    
+    def initial_sample_size(self, risk_function, *args, **kwargs):
+        """
+        TestNonnegMean.initial_sample_size(risk_function, *args, **kwargs), from the cache if 
+        possible. 
+        """
+        key = SampleSizeCache.key(risk_function, *args, **kwargs)
+        if key is None:
+            return TestNonnegMean.initial_sample_size(risk_function, *args, **kwargs)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, key + '.json')
+        if path is not None and os.path.exists(path):
+            self.hits += 1
+            with open(path) as f:
+                sample_size = json.load(f)['sample_size']
+        else:
+            self.misses += 1
+            sample_size = np.asarray(TestNonnegMean.initial_sample_size(risk_function, *args, \
+                                                                        **kwargs)).item()
+            if path is not None:
+                tmp = path + '.tmp{}'.format(os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump({'sample_size': sample_size}, f)
+                os.replace(tmp, path)
+        self.entries[key] = sample_size
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return sample_size
+    
+    def sample_size_function(self, risk_function, N, error_rate, **kwargs):
+        """
+        A sample_size_function for find_sample_size() that goes through the cache.
+        
+        Parameters:
+        -----------
+        risk_function, N, error_rate, kwargs : 
+            the arguments of TestNonnegMean.initial_sample_size other than margin and alpha
+        
+        Returns:
+        --------
+        callable taking the margin and the risk limit
+        """
+        return lambda margin, risk: self.initial_sample_size(risk_function, N, margin, \
+                                                             error_rate, alpha=risk, **kwargs)
+
 # utilities
+
+SampleAlignment = namedtuple('SampleAlignment', 'mvr_sample, cvr_sample, missing, duplicated, extra')
        
 def check_audit_parameters(risk_function, g, error_rate, contests):
     """
@@ -1189,7 +2764,56 @@ def check_audit_parameters(risk_function, g, error_rate, contests):
             assert contests[c]['share_to_win'] >= 0.5, \
                 'super-majority contest requires winning at least 50% of votes in ' + c + ' contest'
 
-def find_margins(contests, assertions, cvr_list):
+_shared = {}  # the functions mapped by _map_tasks, by call, inherited by its worker processes
+_shared_tokens = itertools.count()
+
+def _run_shared(token, task):
+    return _shared[token](task)
+
+def _map_tasks(func, tasks, executor=None, max_workers=None):
+    """
+    [func(task) for task in tasks], optionally spread over a pool of workers.
+    
+    For a process pool, func is not pickled: it is stored in a module global, under a token 
+    for this call, before the workers are forked, so they inherit it, with everything it 
+    refers to (assertions, CVRs, ...), from the parent. Only the token, the tasks and the 
+    results are pickled, and calls running at the same time (e.g., from different threads) 
+    do not see each other's functions. This needs the 'fork' start method: on platforms 
+    without it (e.g., Windows), executor='process' raises ValueError.
+    
+    Parameters:
+    -----------
+    func : callable
+        function of one argument
+    tasks : list
+        the arguments
+    executor : string
+        None to run in this process; 'thread' for a thread pool; 'process' for a process pool
+    max_workers : int
+        number of workers; None for the default of concurrent.futures
+    
+    Returns:
+    --------
+    list of results, in the order of tasks
+    """
+    if executor is None or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+    if executor == 'thread':
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(func, tasks))
+    assert executor == 'process', "unknown executor " + str(executor)
+    workers = max_workers if max_workers is not None else os.cpu_count() or 1
+    context = multiprocessing.get_context('fork')
+    token = next(_shared_tokens)
+    _shared[token] = func
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+            return list(pool.map(_run_shared, itertools.repeat(token, len(tasks)), tasks, \
+                                 chunksize=max(1, len(tasks)//(4*workers))))
+    finally:
+        del _shared[token]
+
+def find_margins(contests, assertions, cvr_list, executor=None, max_workers=None):
     """
     Find all the assorter margins in a set of Assertions. Updates the dict of dicts of assertions,
     and the contest dict.
@@ -1201,28 +2825,39 @@ def find_margins(contests, assertions, cvr_list):
     contests : dict of contest data
     assertions : dict of dicts of Assertions
         Keys in the main dict are contests; keys in the contained dicts are Assertions
+    executor : string
+        optional. 'thread' or 'process' to find the assorter means of the assertions in parallel
+        (see _map_tasks); the workers share cvr_list without copying it for every assertion.
+        'process' forks the workers, and raises ValueError on platforms without 'fork' 
+        (e.g., Windows)
+    max_workers : int
+        number of workers for the executor
     
     Returns:
     --------
     min_margin : double
         smallest margin in the audit        
     """
-    assorter_means = {}
-    min_margin = np.infty
+    rows = [(c, asrtn) for c in contests for asrtn in assertions[c]]
+    # find mean of each assertion for the CVRs
+    assorter_means = dict(zip(rows, _map_tasks(lambda row: \
+                                               assertions[row[0]][row[1]].assorter_mean(cvr_list), \
+                                               rows, executor=executor, max_workers=max_workers)))
+    min_margin = np.inf
     for c in contests:
         contests[c]['margins'] = {}
         for asrtn in assertions[c]:
-            # find mean of the assertion for the CVRs
-            amean = assertions[c][asrtn].assorter_mean(cvr_list)
+            amean = assorter_means[(c, asrtn)]
             if amean < 1/2:
-                warn("assertion {} not satisfied by CVRs: mean value is {}".format(asrtn, amean))
+                warnings.warn("assertion {} not satisfied by CVRs: mean value is {}".format(asrtn, amean))
             margin = 2*amean-1
             assertions[c][asrtn].margin = margin
             contests[c]['margins'].update({asrtn: margin})
             min_margin = np.min([min_margin, margin])
     return min_margin
 
-def find_p_values(contests, assertions, mvr_sample, cvr_sample, manifest_type, risk_function):
+def find_p_values(contests, assertions, mvr_sample, cvr_sample, manifest_type, risk_function, \
+                  running_tests=None, vectorized=False, executor=None, max_workers=None):
     """
     Find the p-value for every assertion in assertions; update data structure to
     include the p-values for the assertions, flag "proved" assertions, and note 
@@ -1249,6 +2884,26 @@ def find_p_values(contests, assertions, mvr_sample, cvr_sample, manifest_type, r
     risk_function : callable
         function to calculate the p-value from overstatement_assorter values
         
+    running_tests : dict of dicts of RunningTest
+        optional. If not None, running_tests[c][asrtn] keeps the state of the risk calculation for
+        each assertion between calls, and only the sheets added to the end of the samples since 
+        the previous call are used to update it. Missing entries are created from risk_function,
+        which must then come from TestNonnegMean.risk_function.
+        
+    vectorized : Boolean
+        if True, risk_function is called once, on the 2-D array of overstatement_assorter values 
+        with one row per assertion, and must return the vector of p-values for the rows. The
+        tests in TestNonnegMean accept 2-D samples. Ignored if running_tests is not None.
+        
+    executor : string
+        optional. 'thread' or 'process' to find the p-values of the assertions in parallel 
+        (see _map_tasks); the workers share the samples without copying them for every 
+        assertion. 'process' forks the workers, and raises ValueError on platforms without 
+        'fork' (e.g., Windows). Ignored if vectorized is True and running_tests is None.
+    
+    max_workers : int
+        number of workers for the executor
+        
     Returns:
     --------
     p_max : double
@@ -1256,6 +2911,30 @@ def find_p_values(contests, assertions, mvr_sample, cvr_sample, manifest_type, r
         
     """
     assert len(mvr_sample) == len(cvr_sample), "unequal numbers of cvrs and mvrs"
+    if vectorized and running_tests is None:
+        rows = [(c, asrtn) for c in contests.keys() for asrtn in assertions[c]]
+        d = np.array([[assertions[c][asrtn].overstatement_assorter(mvr_sample[i], cvr_sample[i], \
+                       assertions[c][asrtn].margin, manifest_type=manifest_type) \
+                       for i in range(len(mvr_sample))] for c, asrtn in rows])
+        p_values = dict(zip(rows, risk_function(d))) if rows else {}
+    else:
+        rows = [(c, asrtn) for c in contests.keys() for asrtn in assertions[c]]
+        for c, asrtn in rows:
+            if running_tests is not None and asrtn not in running_tests.setdefault(c, {}):
+                running_tests[c][asrtn] = RunningTest.from_risk_function(risk_function)
+        def p_value(row):
+            a = assertions[row[0]][row[1]]
+            test = None if running_tests is None else running_tests[row[0]][row[1]]
+            start = 0 if test is None else test.n
+            d = [a.overstatement_assorter(mvr_sample[i], cvr_sample[i],\
+                 a.margin, manifest_type=manifest_type) for i in range(start, len(mvr_sample))]
+            # the updated test is returned, since a worker process updates its own copy
+            return (risk_function(d), None) if test is None else (test.update(d), test)
+        results = _map_tasks(p_value, rows, executor=executor, max_workers=max_workers)
+        p_values = {row: p for row, (p, _) in zip(rows, results)}
+        if running_tests is not None:
+            for (c, asrtn), (_, test) in zip(rows, results):
+                running_tests[c][asrtn] = test
     p_max = 0
     for c in contests.keys():
         contests[c]['p_values'] = {}
@@ -1263,9 +2942,7 @@ def find_p_values(contests, assertions, mvr_sample, cvr_sample, manifest_type, r
         contest_max_p = 0
         for asrtn in assertions[c]:
             a = assertions[c][asrtn]
-            d = [a.overstatement_assorter(mvr_sample[i], cvr_sample[i],\
-                 a.margin, manifest_type=manifest_type) for i in range(len(mvr_sample))]
-            a.p_value = risk_function(d)
+            a.p_value = p_values[(c, asrtn)]
             a.proved = (a.p_value <= contests[c]['risk_limit']) or a.proved
             contests[c]['p_values'].update({asrtn: a.p_value})
             contests[c]['proved'].update({asrtn: int(a.proved)})
@@ -1299,6 +2976,44 @@ def find_sample_size(contests, assertions, sample_size_function):
             sample_size = np.max([sample_size, n] )
     return sample_size
 
+def align_samples(mvr_sample, cvr_sample):
+    """
+    Put the MVRs into the same (random) order in which the CVRs were selected, and find every
+    data integrity problem at once.
+    
+    Builds a dict of the MVRs by id once, so alignment takes time linear in the sample size.
+    Does not modify either list. If the CVR sample lists an id more than once (sampling with
+    replacement), each occurrence is aligned with the same MVR.
+    
+    Parameters:
+    -----------
+    mvr_sample: list of CVR objects 
+        the manually determined votes for the audited cards
+    cvr_sample: list of CVR objects
+        the electronic vote record for the audited cards 
+    
+    Returns:
+    --------
+    SampleAlignment, a namedtuple with fields
+        mvr_sample : list of MVRs in the order of cvr_sample; None where an MVR is missing
+        cvr_sample : list of the CVRs
+        missing : ids of CVRs with no MVR, in sample order
+        duplicated : ids that appear more than once among the MVRs
+        extra : ids of MVRs that do not match any CVR, in the order of mvr_sample
+    """
+    mvr_lookup = {}
+    duplicated = {}  # used as an ordered set
+    for m in mvr_sample:
+        if m.id in mvr_lookup:
+            duplicated[m.id] = None
+        else:
+            mvr_lookup[m.id] = m
+    aligned = [mvr_lookup.get(c.id) for c in cvr_sample]
+    missing = [c.id for c, m in zip(cvr_sample, aligned) if m is None]
+    cvr_ids = set(c.id for c in cvr_sample)
+    extra = [i for i in mvr_lookup if i not in cvr_ids]
+    return SampleAlignment(aligned, list(cvr_sample), missing, list(duplicated), extra)
+
 def prep_sample(mvr_sample, cvr_sample):
     """
     prepare the MVRs and CVRs for comparison by putting the MVRs into the same (random) order
@@ -1306,7 +3021,8 @@ def prep_sample(mvr_sample, cvr_sample):
     
     conduct data integrity checks.
     
-    Side-effects: sorts the mvr sample into the same order as the cvr sample
+    Side-effects: sorts the mvr sample into the same order as the cvr sample. 
+    Use align_samples() to get the aligned sample without modifying mvr_sample.
     
     Parameters:
     -----------
@@ -1318,17 +3034,94 @@ def prep_sample(mvr_sample, cvr_sample):
     Returns:
     --------
     """
-    id_lookup = [c.id for c in cvr_sample]
-    mvr_sample.sort(key= lambda x: id_lookup.index(x.id))
-
-    assert len(cvr_sample) == len(mvr_sample),\
-        "Number of cvrs ({}) and mvrs ({}) doesn't match".format(len(cvr_sample), len(mvr_sample))
-    for i in range(len(cvr_sample)):
-        assert mvr_sample[i].id == cvr_sample[i].id, \
-    "Mismatch between id of cvr ({}) and mvr ({})".format(cvr_sample[i].id, mvr_sample[i].id)
+    alignment = align_samples(mvr_sample, cvr_sample)
+    problems = []
+    if alignment.missing:
+        problems.append("no mvr for cvrs {}".format(alignment.missing))
+    if alignment.duplicated:
+        problems.append("duplicated mvrs {}".format(alignment.duplicated))
+    if alignment.extra:
+        problems.append("mvrs {} match no cvr".format(alignment.extra))
+    if len(cvr_sample) != len(mvr_sample):
+        problems.append("Number of cvrs ({}) and mvrs ({}) doesn't match".format(\
+                        len(cvr_sample), len(mvr_sample)))
+    assert not problems, "; ".join(problems)
+    mvr_sample[:] = alignment.mvr_sample
+
+def _urn_stopping_times(d, risk_function, alpha, reps, prng, N=np.inf, max_cells=10**7):
+    """
+    Stopping times for reps continuations of the sample d, each drawn from a Polya urn that 
+    starts with the values in d: every draw is a uniformly random element of the sample so far.
+    If d is 2-D, its rows are the values of several assorters on the same ballots; one stream of
+    ballot draws feeds every row and the stopping time is the first time every p-value has 
+    reached its risk limit in alpha.
+    The continuations are drawn in blocks that double the sample, and the stopping time is read 
+    from the running p-values of all the continuations at once. A continuation that does not 
+    stop within min(N, max_cells) draws in all gets the size N+1: the urn can settle on a 
+    population for which the test never stops.
+    Each continuation draws its uniforms from its own generator, seeded from prng, so they can 
+    be regenerated for any batch of continuations: no more than about max_cells sample values 
+    (and uniforms) are held at once.
+    """
+    d = np.atleast_2d(np.asarray(d, dtype=float))
+    alpha = np.broadcast_to(alpha, len(d))
+    n0 = d.shape[1]
+    assert n0 > 0, 'empty sample'
+    sams = np.full(reps, N+1, dtype=float)
+    seeds = prng.integers(2**63, size=reps)
+    rows = np.arange(reps)
+    drawn = 0
+    K = n0
+    limit = min(N, max_cells)
+    while len(rows) > 0 and drawn < limit-n0:
+        K = int(min(K, limit-n0))
+        k = np.arange(K)
+        batch = max(1, int(max_cells // (n0+K)))
+        stopped = np.zeros(len(rows), dtype=bool)
+        for start in range(0, len(rows), batch):
+            u = np.array([np.random.default_rng(seeds[r]).random(K) for r in rows[start:start+batch]])
+            src = np.floor(u*(n0+k)).astype(int) # index into d, or n0 + the index of an earlier draw
+            del u
+            later = src >= n0
+            while later.any(): # follow the draws back to d, doubling the steps each time
+                src = np.where(later, np.take_along_axis(src, np.where(later, src-n0, k), axis=1), src)
+                later = src >= n0
+            stop = np.zeros(len(src))
+            for di, alpha_i in zip(d, alpha):
+                x = di[src]
+                x = np.hstack((np.broadcast_to(di, (len(x), n0)), x))
+                crossed = np.atleast_2d(risk_function(x, running=True)) <= alpha_i
+                stop = np.maximum(stop, np.where(crossed.any(axis=1), \
+                                                 np.maximum(n0, np.argmax(crossed, axis=1)+1), np.inf))
+            hit = np.isfinite(stop)
+            sams[rows[start:start+batch][hit]] = stop[hit]
+            stopped[start:start+batch] = hit
+        rows = rows[~stopped]
+        drawn = K
+        K = 2*K
+    return sams
+
+def _bootstrap_sample_sizes(samples, risk_function, reps, seed, N=np.inf, max_cells=10**7, \
+                            joint=False):
+    """
+    new_sample_size for one block of replicates: the largest stopping time over the samples, 
+    a list of (overstatement assorter values, risk limit) for the unproved assertions. If joint,
+    the assertions share the ballot draws. Runs in a worker process.
+    """
+    prng = np.random.default_rng(seed)
+    if joint and samples:
+        d, risk_limits = zip(*samples)
+        return _urn_stopping_times(d, risk_function, risk_limits, reps, prng, N=N, \
+                                   max_cells=max_cells)
+    sams = np.zeros(reps)
+    for d, risk_limit in samples:
+        sams = np.maximum(sams, _urn_stopping_times(d, risk_function, risk_limit, reps, prng, N=N, \
+                                                    max_cells=max_cells))
+    return sams
 
 def new_sample_size(contests, assertions, mvr_sample, cvr_sample, manifest_type,\
-                    risk_function, quantile=0.5, reps=200, seed=1234567890):
+                    risk_function, quantile=0.5, reps=200, seed=1234567890, running=False, \
+                    max_workers=1, N=np.inf, max_cells=10**7, joint=False):
     """
     Estimate the total sample size expected to allow the audit to complete,
     if discrepancies continue at the same rate already observed.
@@ -1362,7 +3155,35 @@ def new_sample_size(contests, assertions, mvr_sample, cvr_sample, manifest_type,
         number of replications to use to estimate the quantile
     
     seed : int
-        seed for the Mersenne Twister prng
+        seed for the Mersenne Twister prng (for the default PCG64 prng if running is True)
+        
+    running : boolean
+        if True, risk_function must accept the keyword argument `running` (see 
+        TestNonnegMean.risk_function). The simulated sample is then doubled in length at a time
+        and the stopping time is read from the running p-values, instead of recomputing the
+        p-value after every additional draw. The overstatement assorter values are found once, 
+        and the replicates are simulated in blocks of 64, all the replicates in a block at once, 
+        so risk_function must also accept a 2-D sample (see TestNonnegMean). Each block uses its
+        own seed, derived from seed, so the result does not depend on max_workers. 
+    
+    max_workers : int
+        if running is True, the number of worker processes to simulate blocks of replicates. 
+        If max_workers != 1, risk_function must be picklable (e.g., made by 
+        TestNonnegMean.risk_function). None uses all the processors.
+    
+    N : int
+        if running is True, the simulated samples do not grow beyond N. Replicates whose p-value
+        does not reach the risk limit by then get the size N+1
+        
+    max_cells : int
+        if running is True, the largest number of sample values to evaluate at once. A replicate
+        that has not stopped after max_cells draws also gets the size N+1
+        
+    joint : boolean
+        if True, each replicate draws one stream of ballots (sheets) and every unproved 
+        assertion is evaluated on it, as in the audit itself: the size for the replicate is the 
+        first time all the assertions are confirmed. If False, each assertion is simulated 
+        with its own draws and the size is the largest of their stopping times.
     
     Returns:
     --------
@@ -1371,11 +3192,51 @@ def new_sample_size(contests, assertions, mvr_sample, cvr_sample, manifest_type,
     sams : array of ints
         array of all sizes found in the simulation
     """
+    if running:
+        samples = []
+        for c in contests:
+            for asrtn in assertions[c]:
+                a = assertions[c][asrtn]
+                if not a.proved:
+                    samples.append(([a.overstatement_assorter(mvr_sample[i], cvr_sample[i],\
+                                     a.margin, manifest_type=manifest_type) \
+                                     for i in range(len(mvr_sample))], contests[c]['risk_limit']))
+        blocks = [min(64, reps-start) for start in range(0, reps, 64)]
+        seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+        args = [(samples, risk_function, b, s, N, max_cells, joint) for b, s in zip(blocks, seeds)]
+        if max_workers == 1 or len(blocks) <= 1:
+            sams = [_bootstrap_sample_sizes(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                sams = list(executor.map(_bootstrap_sample_sizes, *zip(*args)))
+        sams = np.concatenate(sams)
+        return np.quantile(sams, quantile), sams
     new_size = 0
     prng = np.random.RandomState(seed=seed)
     sams = np.zeros(reps)
     for r in range(reps):
         new_size = 0
+        if joint:
+            ds, ps, limits = [], [], []
+            for c in contests:
+                for asrtn in assertions[c]:
+                    a = assertions[c][asrtn]
+                    if not a.proved:
+                        ds.append([a.overstatement_assorter(mvr_sample[i], cvr_sample[i],\
+                                   a.margin, manifest_type=manifest_type) \
+                                   for i in range(len(mvr_sample))])
+                        ps.append(a.p_value)
+                        limits.append(contests[c]['risk_limit'])
+            new_size = len(mvr_sample) if ds else 0
+            pending = [k for k in range(len(ds)) if ps[k] > limits[k]]
+            while pending:
+                one_more = sample_by_index(new_size, 1, prng=prng)[0]
+                for d in ds:
+                    d.append(d[one_more-1])
+                new_size += 1
+                pending = [k for k in pending if risk_function(ds[k]) > limits[k]]
+            sams[r] = new_size
+            continue
         for c in contests:
             for asrtn in assertions[c]:
                 if not assertions[c][asrtn].proved:    
@@ -1383,11 +3244,13 @@ def new_sample_size(contests, assertions, mvr_sample, cvr_sample, manifest_type,
                     p = a.p_value
                     d = [a.overstatement_assorter(mvr_sample[i], cvr_sample[i],\
                          a.margin, manifest_type=manifest_type) for i in range(len(mvr_sample))]
+                    size = len(d)
                     while p > contests[c]['risk_limit']:
                         one_more = sample_by_index(len(d), 1, prng=prng)[0]
                         d.append(d[one_more-1])
                         p = risk_function(d)
-                    new_size = np.max([new_size, len(d)])
+                        size = len(d)
+                    new_size = np.max([new_size, size])
         sams[r] = new_size 
     new_size = np.quantile(sams, quantile)
     return new_size, sams
@@ -1527,6 +3390,36 @@ def test_supermajority_assorter():
     votes = CVR.from_vote({"Alice": False, "Bob": True, "Candy": True})
     assert assn['Alice v all'].assorter.assort(votes) == 1/2, "wrong value for invalid vote--Bob & Candy"
 
+def test_assorter_spec():
+    import pickle
+    with open('Data/SF2019Nov8Assertions.json') as fid:
+        audit = json.load(fid)['audits'][0]
+    assertions = Assertion.make_assertions_from_json(audit['contest'], \
+                       [audit['winner']] + audit['eliminated'], audit['assertions'])
+    assertions.update(Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob', 'Candy']))
+    assertions.update(Assertion.make_supermajority_assertion('AvB', 'Alice', ['Bob', 'Candy'], 2/3))
+    assert {a.assorter.spec.kind for a in assertions.values()} == set(Assorter.SPEC_KINDS)
+    with open('Data/SFDA_2019_Nov8Partial.raire') as fid:
+        cvr_list = CVR.from_raire(list(csv.reader(fid)))[::50]
+    cvr_list += CVR.from_dict([{'id': 'a', 'votes': {'AvB': {'Alice': True}}}, \
+                               {'id': 'b', 'votes': {'AvB': {'Bob': True}}}, \
+                               {'id': 'c', 'votes': {'AvB': {'Alice': True, 'Candy': True}}}])
+    cvr_table = CVRTable.from_cvrs(cvr_list)
+    # the assertions survive pickling, and assorters rebuilt from json specs agree
+    copies = pickle.loads(pickle.dumps(assertions))
+    for name, a in assertions.items():
+        rebuilt = Assorter.from_spec(AssorterSpec(*json.loads(json.dumps(a.assorter.spec))))
+        assert rebuilt.spec == a.assorter.spec
+        assert rebuilt.upper_bound == a.assorter.upper_bound
+        has_contest = np.array([c.has_contest(a.contest) for c in cvr_list])
+        expected = [a.assorter.assort(c) for c, h in zip(cvr_list, has_contest) if h]
+        for assorter in [copies[name].assorter, rebuilt]:
+            np.testing.assert_array_equal([assorter.assort(c) for c, h in \
+                                           zip(cvr_list, has_contest) if h], expected)
+            np.testing.assert_array_equal(assorter.assort_table(cvr_table)[has_contest], expected)
+    assert Assorter.from_spec({'kind': 'plurality', 'contest': 'AvB', 'winner': 'Alice', \
+                               'loser': 'Bob'}).assort(cvr_list[-3]) == 1
+
 def test_rcv_lfunc_wo():
     votes = CVR.from_vote({"Alice": 1, "Bob": 2, "Candy": 3, "Dan": ''})
     assert CVR.rcv_lfunc_wo("AvB", "Bob", "Alice", votes) == 1
@@ -1827,6 +3720,28 @@ def test_kaplan_kolmogorov():
     x = np.zeros(10)
     p2 = TestNonnegMean.kaplan_kolmogorov(x, N, t=1/2, g=0.1, random_order = True)
     print("kaplan_kolmogorov: {} {}".format(p1, p2))
+    x = [1, 1]
+    np.testing.assert_almost_equal(TestNonnegMean.kaplan_kolmogorov(x, 4, t=1/2), 1/3)
+    x = [1, 3, 3] # the sample total exceeds N*t, so the martingale is infinite from the third draw
+    p = TestNonnegMean.kaplan_kolmogorov(x, 4, t=1/2, running=True)
+    np.testing.assert_almost_equal(p, [1/2, 1/9, 1/9])
+    p = TestNonnegMean.kaplan_kolmogorov(x, 4, t=1/2, random_order=False, running=True)
+    np.testing.assert_almost_equal(p, [1/2, 1/9, 0])
+    
+def test_wald_sprt():
+    x = [1, 1, 0]
+    p = TestNonnegMean.wald_sprt(x, np.inf, t=1/2, p1=3/4, running=True)
+    np.testing.assert_almost_equal(p, [2/3, 4/9, 4/9])
+    p = TestNonnegMean.wald_sprt(x, np.inf, t=1/2, p1=3/4, random_order=False)
+    np.testing.assert_almost_equal(p, 8/9)
+    x = [1, 1, 1]
+    p = TestNonnegMean.wald_sprt(x, 4, t=1/2, p1=3/4, running=True)
+    np.testing.assert_almost_equal(p, [2/3, 1/3, 0])
+    try:
+        TestNonnegMean.wald_sprt([0, 2], np.inf)
+        raise AssertionError('non-binary data accepted')
+    except ValueError:
+        pass
 
 def test_initial_sample_size():
     N_cards = int(10**3)
@@ -1870,7 +3785,50 @@ def test_initial_sample_size_KW():
                             bias_up=bias_up, quantile=0.5, seed=1234567890)
     np.testing.assert_array_less(sam_size_0, sam_size+1) # crude test, but ballpark
     np.testing.assert_array_less(sam_size, sam_size_1+1) # crude test, but ballpark
+    # the same, from running p-values
+    risk_function = TestNonnegMean.risk_function('kaplan_wald', t=1/2, g=g, random_order=False)
+    for bias_up, size in [(False, sam_size_0), (True, sam_size_1)]:
+        sam_size = TestNonnegMean.initial_sample_size(risk_function, N, margin, error_rate, \
+                            alpha=alpha, t=1/2, reps=None, bias_up=bias_up, running=True)
+        np.testing.assert_almost_equal(sam_size, size)
+    # by bisection, and one item at a time
+    for m in [0.1, 0.05, 0.02]:
+        for bias_up in [True, False]:
+            risk_function = TestNonnegMean.risk_function('kaplan_kolmogorov', N=N, g=0.1)
+            sizes = [TestNonnegMean.initial_sample_size(risk_function, N, m, error_rate, \
+                            bias_up=bias_up, monotone=monotone) for monotone in [True, False]]
+            np.testing.assert_equal(sizes[0], sizes[1])
+    risk_function = TestNonnegMean.risk_function('kaplan_wald', t=1/2, g=g, random_order=False)
+    sam_size_loop = TestNonnegMean.initial_sample_size(risk_function, N, margin, error_rate, \
+                            alpha=alpha, reps=100)
+    sam_size = TestNonnegMean.initial_sample_size(risk_function, N, margin, error_rate, \
+                            alpha=alpha, reps=100, running=True)
+    for size in [sam_size, sam_size_loop]: # the random numbers differ, so check the ballpark
+        np.testing.assert_array_less(sam_size_0, size+1)
+        np.testing.assert_array_less(size, sam_size_1+1)
+    # the simulated sizes do not depend on how many are evaluated at once
+    draw = lambda u: np.where(u <= error_rate, one_over, clean)
+    sams = [TestNonnegMean.simulate_stopping_times(risk_function, draw, 300, N, alpha, block=32, \
+                                                   max_cells=max_cells) for max_cells in [10**6, 500]]
+    np.testing.assert_array_equal(sams[0], sams[1])
+    assert np.all(sams[0] >= sam_size_0) and np.all(sams[0] <= N)
     
+def test_integral_from_roots():
+    prng = np.random.RandomState(12345)
+    c = prng.uniform(-1, 2, size=30)
+    integral, integrals = TestNonnegMean.integral_from_roots(c, maximal=False)
+    for k in [1, 2, 10, 30]:
+        poly = np.polyint(np.poly(c[:k]))
+        np.testing.assert_almost_equal(integrals[k-1], np.polyval(poly, 1) - np.polyval(poly, 0))
+    np.testing.assert_almost_equal(integral, integrals[-1])
+    integral, integrals = TestNonnegMean.integral_from_roots(c, maximal=True)
+    np.testing.assert_almost_equal(integral, np.max(integrals[1:]))
+    # appending roots gives the same result as starting over
+    state = TestNonnegMean.extend_integrals(c[:7])
+    state = TestNonnegMean.extend_integrals(c[7:], state)
+    np.testing.assert_array_equal(state.integrals, integrals)
+    assert len(state.coefficients) == len(c)+1
+
 def test_kaplan_martingale():
     eps = 0.0001  # Generic small value for use when not sure exactly how small it should be.
     
@@ -1885,8 +3843,401 @@ def test_kaplan_martingale():
     s = [0.6,0.8,1.0,1.2,1.4]
     np.testing.assert_array_less(TestNonnegMean.kaplan_martingale(s, N=100000, t=0, random_order = True)[:1],[eps])
 
+    # the sample total reaches N*t exactly before a positive draw: the null is impossible
+    s = [1,0,0,1,1,0,1,0,0,1,1,1]
+    for random_order in [True, False]:
+        p = TestNonnegMean.kaplan_martingale(s, N=12, t=0.5, random_order=random_order)[0]
+        assert p == 0
+        p_running = TestNonnegMean.kaplan_martingale(s, N=12, t=0.5, random_order=random_order, \
+                                                     running=True)
+        assert not np.any(np.isnan(p_running)) and p_running[-1] == 0
+        for j in range(1, len(s)+1):
+            np.testing.assert_almost_equal(p_running[j-1], TestNonnegMean.kaplan_martingale(\
+                                           s[:j], N=12, t=0.5, random_order=random_order)[0])
+
+def test_long_samples():
+    # the martingales pass through values a double cannot hold before coming back
+    x = np.array([10]*400 + [1/20]*400)
+    p = TestNonnegMean.kaplan_wald(x, t=1/2, random_order=False)
+    np.testing.assert_allclose(np.log(p), -400*np.log(2))
+    p = TestNonnegMean.kaplan_markov(x, t=1/2, random_order=False)
+    np.testing.assert_allclose(np.log(p), -400*np.log(2))
+    # KMart on a sample with mean a little above the null
+    x = np.tile([0.4, 0.62], 1500)
+    p, mart = TestNonnegMean.kaplan_martingale(x, N=10**6, t=1/2, random_order=False)
+    assert 0 < p < 0.05 and np.all(np.isfinite(mart)) and len(mart) == len(x)
+    p_running = TestNonnegMean.kaplan_martingale(x, N=10**6, t=1/2, random_order=False, running=True)
+    np.testing.assert_allclose(p_running[-1], p)
+    # compare with the integral over u by the midpoint rule, in log space
+    N, t = 10**6, 1/2
+    y = x*(1-np.arange(len(x))/N)/(t - np.insert(np.cumsum(x), 0, 0)[:-1]/N)
+    u = (np.arange(20000)+1/2)/20000
+    log_f = np.zeros_like(u)
+    for yy in y:
+        log_f += np.log(1 + u*(yy-1))
+    log_mart = np.max(log_f) + np.log(np.mean(np.exp(log_f - np.max(log_f))))
+    np.testing.assert_allclose(np.log(p), -log_mart, rtol=1e-6)
+
+def test_prep_sample():
+    cvrs = CVR.from_dict([{'id': i, 'votes': {}} for i in ['c', 'a', 'd', 'b']])
+    mvrs = CVR.from_dict([{'id': i, 'votes': {}} for i in ['a', 'b', 'c', 'd']])
+    alignment = align_samples(mvrs, cvrs)
+    assert [m.id for m in alignment.mvr_sample] == ['c', 'a', 'd', 'b']
+    assert [m.id for m in mvrs] == ['a', 'b', 'c', 'd']  # not modified
+    assert alignment.missing == alignment.duplicated == alignment.extra == []
+    prep_sample(mvrs, cvrs)
+    assert [m.id for m in mvrs] == ['c', 'a', 'd', 'b']
+
+    mvrs = CVR.from_dict([{'id': i, 'votes': {}} for i in ['a', 'e', 'b', 'a', 'c', 'f']])
+    alignment = align_samples(mvrs, cvrs)
+    assert alignment.missing == ['d']
+    assert alignment.duplicated == ['a']
+    assert alignment.extra == ['e', 'f']
+    assert alignment.mvr_sample[2] is None
+    mvrs = CVR.from_dict([{'id': i, 'votes': {}} for i in ['b', 'a', 'b', 'c', 'a', 'b', 'd']])
+    assert align_samples(mvrs, cvrs).duplicated == ['b', 'a']  # each once, in order
+    mvrs = CVR.from_dict([{'id': i, 'votes': {}} for i in ['a', 'e', 'b', 'a', 'c', 'f']])
+    try:
+        prep_sample(mvrs, cvrs)
+    except AssertionError as e:
+        assert "'d'" in str(e) and "'e', 'f'" in str(e)
+    else:
+        raise AssertionError
+
+def test_running_p_values():
+    # the running p-values agree with the p-values of every prefix
+    prng = np.random.RandomState(12345)
+    N = 200
+    for x in [prng.uniform(0, 1.2, size=40), np.r_[np.ones(10), np.zeros(5), np.ones(20)], \
+              1/1.9*np.ones(30), np.r_[0.9*np.ones(10), 0.2*np.ones(20)], np.r_[5*np.ones(30)]]:
+        tests = [lambda y, **kw: TestNonnegMean.kaplan_markov(y, g=0.1, **kw),
+                 lambda y, **kw: TestNonnegMean.kaplan_wald(y, g=0.1, **kw),
+                 lambda y, **kw: TestNonnegMean.kaplan_kolmogorov(y, N=N, g=0.1, **kw),
+                 lambda y, **kw: TestNonnegMean.p_value('kaplan_martingale', y, N=N, **kw)]
+        if np.all((x == 0) | (x == 1)):
+            tests.append(lambda y, **kw: TestNonnegMean.wald_sprt(y, N=N, p1=0.7, **kw))
+            tests.append(lambda y, **kw: TestNonnegMean.wald_sprt(y, N=np.inf, p1=0.7, **kw))
+        for test in tests:
+            for random_order in [True, False]:
+                running = test(x, random_order=random_order, running=True)
+                assert len(running) == len(x)
+                expected = [test(x[:j], random_order=random_order) for j in range(1, len(x)+1)]
+                np.testing.assert_allclose(running, expected, rtol=1e-10)
+    p = [1, 0.5, 0.06, 0.05, 0.01]
+    assert TestNonnegMean.first_crossing(p, 0.05) == 3
+    assert TestNonnegMean.first_crossing(p, 0.001) is None
+    risk_fn = TestNonnegMean.risk_function('kaplan_martingale', N=N)
+    x = prng.uniform(0.4, 1.2, size=20)
+    np.testing.assert_almost_equal(risk_fn(x), TestNonnegMean.kaplan_martingale(x, N=N)[0])
+    np.testing.assert_almost_equal(risk_fn(x, running=True)[-1], risk_fn(x))
+    assert risk_fn.args == ('kaplan_martingale',) and risk_fn.keywords == {'N': N}
+
+def test_running_test():
+    prng = np.random.RandomState(20201023)
+    x = prng.uniform(0.3, 0.8, size=200)
+    xb = (x > 0.5).astype(float)
+    for test, kwargs, sample in [('kaplan_markov', {'g': 0.1}, x), ('kaplan_wald', {'g': 0.1}, x), \
+                                 ('kaplan_kolmogorov', {'N': 1000, 'g': 0.1}, x), \
+                                 ('wald_sprt', {'N': 1000, 'p1': 0.7}, xb), \
+                                 ('kaplan_martingale', {'N': 1000}, x)]:
+        for random_order in [True, False]:
+            risk_function = TestNonnegMean.risk_function(test, random_order=random_order, **kwargs)
+            p = risk_function(sample, running=True)
+            running_test = RunningTest.from_risk_function(risk_function)
+            for start, end in [(0, 1), (1, 50), (50, 51), (51, 51), (51, 200)]:
+                np.testing.assert_allclose(running_test.update(sample[start:end]), p[end-1])
+            assert running_test.n == len(sample)
+    # the sample total reaches N*t exactly before a positive draw
+    s = np.array([1,0,0,1,1,0,1,0,0,1,1,1], dtype=float)
+    for random_order in [True, False]:
+        running_test = RunningTest('kaplan_martingale', N=12, t=0.5, random_order=random_order)
+        p = [running_test.update(s[j:j+1]) for j in range(len(s))]
+        np.testing.assert_array_equal(p, TestNonnegMean.kaplan_martingale(s, N=12, t=0.5, \
+                                      random_order=random_order, running=True))
+        assert p[-1] == 0 and running_test.stopped == 'infinite'
+    running_test = RunningTest('kaplan_kolmogorov', N=4, t=1/2)
+    np.testing.assert_almost_equal([running_test.update(xx) for xx in [1, 3, 3]], [1/2, 1/9, 1/9])
+    # find_p_values only uses the new sheets
+    contests = {'AvB': {'risk_limit': 0.05}}
+    assertions = {'AvB': Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob'])}
+    votes = [{'Alice': True}]*12 + [{'Bob': True}]*8
+    cvr_sample = CVR.from_dict([{'id': i, 'votes': {'AvB': v}} for i, v in enumerate(votes)])
+    mvr_sample = CVR.from_dict([{'id': i, 'votes': {'AvB': v}} for i, v in enumerate(votes)])
+    mvr_sample[3].votes = {'AvB': {}}
+    assertions['AvB']['Alice v Bob'].margin = 0.2
+    risk_function = TestNonnegMean.risk_function('kaplan_wald', g=0.1)
+    running_tests = {}
+    find_p_values(contests, assertions, mvr_sample[:10], cvr_sample[:10], "STYLE", risk_function, \
+                  running_tests=running_tests)
+    p_max = find_p_values(contests, assertions, mvr_sample, cvr_sample, "STYLE", risk_function, \
+                          running_tests=running_tests)
+    assert running_tests['AvB']['Alice v Bob'].n == 20
+    np.testing.assert_almost_equal(p_max, find_p_values(contests, assertions, mvr_sample, \
+                                                        cvr_sample, "STYLE", risk_function))
+
+def test_batched_tests():
+    prng = np.random.RandomState(20201104)
+    x = prng.uniform(0.3, 0.8, size=(5, 100))
+    x[2, 40:] = 2 # sample total exceeds N*t
+    N = np.array([200, 500, 100, 1000, 10**6])
+    t = np.array([0.5, 0.45, 0.5, 0.55, 0.5])
+    for test, kwargs, sample in [('kaplan_markov', {'t': t, 'g': 0.1}, x), \
+                                 ('kaplan_wald', {'t': t, 'g': [0, 0.1, 0.1, 0.2, 0.1]}, x), \
+                                 ('kaplan_kolmogorov', {'N': N, 't': t, 'g': 0.1}, x), \
+                                 ('wald_sprt', {'N': [200, np.inf, 100, 1000, 10**6], 't': t, \
+                                                'p1': 0.7}, (x > 0.5).astype(float)), \
+                                 ('kaplan_martingale', {'N': N, 't': t}, x)]:
+        for random_order in [True, False]:
+            risk_function = TestNonnegMean.risk_function(test, random_order=random_order, **kwargs)
+            p = risk_function(sample)
+            p_running = risk_function(sample, running=True)
+            assert p.shape == (5,) and p_running.shape == (5, 100)
+            for r in range(5):
+                row_kwargs = {k: np.asarray(v)[r] if np.ndim(v) else v for k, v in kwargs.items()}
+                row_function = TestNonnegMean.risk_function(test, random_order=random_order, \
+                                                            **row_kwargs)
+                np.testing.assert_allclose(p[r], row_function(sample[r]))
+                np.testing.assert_allclose(p_running[r], row_function(sample[r], running=True))
+    # all the assertions in the election at once
+    contests = {'AvB': {'risk_limit': 0.05}, 'CvD': {'risk_limit': 0.1}}
+    assertions = {'AvB': Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob']), \
+                  'CvD': Assertion.make_plurality_assertions('CvD', ['Carol'], ['Dan', 'Erin'])}
+    votes = [{'AvB': {'Alice': True}, 'CvD': {'Carol': True}}]*12 + \
+            [{'AvB': {'Bob': True}, 'CvD': {'Dan': True}}]*5 + [{'AvB': {}, 'CvD': {'Erin': True}}]*3
+    cvr_sample = CVR.from_dict([{'id': i, 'votes': v} for i, v in enumerate(votes)])
+    mvr_sample = CVR.from_dict([{'id': i, 'votes': v} for i, v in enumerate(votes)])
+    mvr_sample[0].votes = {'AvB': {'Bob': True}, 'CvD': {}}
+    for a, m in zip(assertions['AvB'].values(), [0.35]): 
+        a.margin = m
+    for a, m in zip(assertions['CvD'].values(), [0.35, 0.45]):
+        a.margin = m
+    risk_function = TestNonnegMean.risk_function('kaplan_kolmogorov', N=100, g=0.1)
+    p_max = find_p_values(contests, assertions, mvr_sample, cvr_sample, "STYLE", risk_function, \
+                          vectorized=True)
+    p_values = dict(contests['CvD']['p_values'])
+    np.testing.assert_almost_equal(p_max, find_p_values(contests, assertions, mvr_sample, \
+                                                        cvr_sample, "STYLE", risk_function))
+    for asrtn, p in p_values.items():
+        np.testing.assert_almost_equal(p, contests['CvD']['p_values'][asrtn])
+
+def test_executors():
+    contests = {'AvB': {'risk_limit': 0.05}, 'CvD': {'risk_limit': 0.1}}
+    votes = [{'AvB': {'Alice': True}, 'CvD': {'Carol': True}}]*12 + \
+            [{'AvB': {'Bob': True}, 'CvD': {'Dan': True}}]*5 + [{'AvB': {}, 'CvD': {'Erin': True}}]*3
+    cvr_sample = CVR.from_dict([{'id': i, 'votes': v} for i, v in enumerate(votes)])
+    mvr_sample = CVR.from_dict([{'id': i, 'votes': v} for i, v in enumerate(votes)])
+    mvr_sample[0].votes = {'AvB': {'Bob': True}, 'CvD': {}}
+    risk_function = TestNonnegMean.risk_function('kaplan_kolmogorov', N=100, g=0.1)
+    results = []
+    for executor in [None, 'thread', 'process']:
+        assertions = {'AvB': Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob']), \
+                      'CvD': Assertion.make_plurality_assertions('CvD', ['Carol'], ['Dan', 'Erin'])}
+        min_margin = find_margins(contests, assertions, cvr_sample, executor=executor, \
+                                  max_workers=2)
+        p_max = find_p_values(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                              risk_function, executor=executor, max_workers=2)
+        running_tests = {}
+        find_p_values(contests, assertions, mvr_sample[:10], cvr_sample[:10], "STYLE", \
+                      risk_function, running_tests=running_tests, executor=executor, max_workers=2)
+        p_running = find_p_values(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                                  risk_function, running_tests=running_tests, executor=executor, \
+                                  max_workers=2)
+        assert running_tests['CvD']['Carol v Erin'].n == 20
+        results.append([min_margin, p_max, p_running, \
+                        {c: dict(contests[c]['margins']) for c in contests}, \
+                        {c: dict(contests[c]['p_values']) for c in contests}, \
+                        {c: dict(contests[c]['proved']) for c in contests}, \
+                        {c: contests[c]['max_p'] for c in contests}, \
+                        [a.p_value for c in assertions for a in assertions[c].values()]])
+    np.testing.assert_almost_equal(results[0][1], results[0][2])
+    for result in results[1:]:
+        assert result == results[0]
+    # process pools mapping different functions at the same time
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(_map_tasks, lambda x, k=k: (k, x*x), list(range(20)), \
+                               executor='process', max_workers=2) for k in range(4)]
+        for k, future in enumerate(futures):
+            assert future.result() == [(k, x*x) for x in range(20)]
+    assert _shared == {}
+
+def test_run_length_sample():
+    x = [1, 1, 0.5, 0.5, 0.5, 1]
+    sample = TestNonnegMean.run_length_encode(x)
+    np.testing.assert_array_equal(sample.values, [1, 0.5, 1])
+    np.testing.assert_array_equal(sample.lengths, [2, 3, 1])
+    sample = TestNonnegMean.run_length_encode([1, 1, 0], sample)
+    np.testing.assert_array_equal(sample.values, [1, 0.5, 1, 0])
+    np.testing.assert_array_equal(sample.lengths, [2, 3, 3, 1])
+    # comparison audit: mostly clean, a few understatements and overstatements
+    prng = np.random.RandomState(20201120)
+    x = prng.choice([1/1.9, 1/3.8, 0, 1.5/1.9], size=2000, p=[0.985, 0.01, 0.002, 0.003])
+    sample = TestNonnegMean.run_length_encode(x)
+    ends = np.cumsum(sample.lengths) - 1
+    for test, kwargs in [('kaplan_markov', {'g': 0.1}), ('kaplan_wald', {'g': 0.1}), \
+                         ('kaplan_kolmogorov', {'N': 10**4, 'g': 0.1}), \
+                         ('kaplan_kolmogorov', {'N': 2000, 't': 0.6})]:
+        for random_order in [True, False]:
+            risk_function = TestNonnegMean.risk_function(test, random_order=random_order, **kwargs)
+            np.testing.assert_allclose(risk_function(sample), risk_function(x), rtol=1e-8)
+            np.testing.assert_allclose(risk_function(sample, running=True), \
+                                       risk_function(x, running=True)[ends], rtol=1e-8)
+    # the martingale becomes infinite inside a run
+    sample = TestNonnegMean.run_length_encode([1, 3, 3])
+    np.testing.assert_almost_equal(TestNonnegMean.kaplan_kolmogorov(sample, 4, t=1/2), 1/9)
+    np.testing.assert_almost_equal(TestNonnegMean.kaplan_kolmogorov(sample, 4, t=1/2, \
+                                   random_order=False), 0)
+    # the other tests do not take run lengths
+    for test, kwargs in [('wald_sprt', {'N': 1000, 'p1': 0.7}), ('kaplan_martingale', {'N': 1000})]:
+        for f in [functools.partial(getattr(TestNonnegMean, test), **kwargs), \
+                  TestNonnegMean.risk_function(test, **kwargs)]:
+            for running in [False, True]:
+                try:
+                    f(sample, running=running)
+                except TypeError:
+                    pass
+                else:
+                    raise AssertionError(test + " accepted a RunLengthSample")
+
+def test_new_sample_size():
+    contests = {'AvB': {'risk_limit': 0.05}}
+    assertions = {'AvB': Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob'])}
+    votes = [{'Alice': True}]*12 + [{'Bob': True}]*8
+    cvr_sample = CVR.from_dict([{'id': i, 'votes': {'AvB': v}} for i, v in enumerate(votes)])
+    mvr_sample = CVR.from_dict([{'id': i, 'votes': {'AvB': v}} for i, v in enumerate(votes)])
+    mvr_sample[0].votes = {'AvB': {}}  # one 1-vote overstatement
+    a = assertions['AvB']['Alice v Bob']
+    a.margin = 0.3
+    risk_function = TestNonnegMean.risk_function('kaplan_wald', g=0.1)
+    a.p_value = risk_function([a.overstatement_assorter(m, c, a.margin) for m, c in \
+                               zip(mvr_sample, cvr_sample)])
+    sizes = []
+    for running in [False, True]:
+        new_size, sams = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                                         risk_function, reps=20, running=running)
+        assert len(sams) == 20 and np.all(sams > len(cvr_sample))
+        sizes.append(new_size)
+    np.testing.assert_array_less(sizes[1], 2*sizes[0])  # crude test, but ballpark
+    np.testing.assert_array_less(sizes[0], 2*sizes[1])
+    # blocks of replicates are seeded independently of the number of worker processes
+    serial = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                             risk_function, reps=150, running=True)[1]
+    parallel = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                               risk_function, reps=150, running=True, max_workers=2)[1]
+    np.testing.assert_array_equal(serial, parallel)
+    capped = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                             risk_function, reps=150, running=True, N=30)[1]
+    assert np.all((capped >= len(cvr_sample)) & (capped <= 31)) and np.any(capped == 31)
+    # continuations that never stop are simulated within about max_cells values at a time
+    import tracemalloc
+    hopeless = np.r_[np.full(10, 0.3), np.full(10, 0.55)]  # mean < 1/2
+    tracemalloc.start()
+    sams = _urn_stopping_times(hopeless, risk_function, 0.05, 64, np.random.default_rng(1), \
+                               max_cells=10**5)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert np.all(sams == np.inf) and peak < 16*8*10**5
+    # an unproved assertion whose p-value is already below the risk limit needs no more draws
+    p_value = a.p_value
+    a.p_value = 0.01
+    for joint in [False, True]:
+        for running in [False, True]:
+            new_size, sams = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                    TestNonnegMean.risk_function('kaplan_wald', g=0.1, t=0.1), reps=5, \
+                    running=running, joint=joint)
+            assert new_size == len(mvr_sample) and np.all(sams == len(mvr_sample))
+    a.p_value = p_value
+    # joint simulation: a second contest with the same ballots and assertion needs no extra draws
+    contests['AvB2'] = contests['AvB']
+    assertions['AvB2'] = {'Alice v Bob': a}
+    for running in [False, True]:
+        single = new_sample_size({'AvB': contests['AvB']}, assertions, mvr_sample, cvr_sample, \
+                                 "STYLE", risk_function, reps=20, running=running, joint=True)[1]
+        joint = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                                risk_function, reps=20, running=running, joint=True)[1]
+        separate = new_sample_size(contests, assertions, mvr_sample, cvr_sample, "STYLE", \
+                                   risk_function, reps=20, running=running)[1]
+        np.testing.assert_array_equal(single, joint)
+        assert np.mean(joint) <= np.mean(separate)
+
+def test_sample_size_cache():
+    import tempfile
+    contests = {'AvB': {'risk_limit': 0.05}, 'CvD': {'risk_limit': 0.05}, 'EvF': {'risk_limit': 0.1}}
+    assertions = {c: Assertion.make_plurality_assertions(c, [c[0]], [c[2]]) for c in contests}
+    for c in contests:
+        for a in assertions[c].values():
+            a.margin = 0.1
+    risk_function = TestNonnegMean.risk_function('kaplan_wald', g=0.1)
+    expected = [TestNonnegMean.initial_sample_size(risk_function, 10000, 0.1, 0.001, alpha=r) \
+                for r in [0.05, 0.1]]
+    with tempfile.TemporaryDirectory() as d:
+        cache = SampleSizeCache(cache_dir=d)
+        ss_fn = cache.sample_size_function(risk_function, 10000, 0.001)
+        assert find_sample_size(contests, assertions, ss_fn) == max(expected)
+        assert (cache.misses, cache.hits) == (2, 1) and len(os.listdir(d)) == 2
+        assert cache.initial_sample_size(risk_function, 10000, 0.1, 0.001, 0.1) == expected[1]
+        assert cache.hits == 2
+        cache = SampleSizeCache(maxsize=1, cache_dir=d)  # a new session reads the entries on disk
+        assert [ss_fn(0.1, r) for r in [0.05, 0.1]] == expected
+        assert [cache.initial_sample_size(risk_function, 10000, 0.1, 0.001, alpha=r) \
+                for r in [0.05, 0.1]] == expected
+        assert (cache.misses, cache.hits, len(cache.entries)) == (0, 2, 1)
+    # other parameters, tests, and test parameters give other keys; lambdas are not cached
+    key = SampleSizeCache.key(risk_function, 10000, 0.1, 0.001)
+    assert key == SampleSizeCache.key(risk_function, 10000, 0.1, 0.001, alpha=0.05, max_cells=10)
+    assert key != SampleSizeCache.key(risk_function, 10000, 0.1, 0.001, reps=10)
+    assert key != SampleSizeCache.key(TestNonnegMean.risk_function('kaplan_wald', g=0.2), \
+                                      10000, 0.1, 0.001)
+    assert key != SampleSizeCache.key(TestNonnegMean.risk_function('kaplan_markov', g=0.1), \
+                                      10000, 0.1, 0.001)
+    assert SampleSizeCache.key(lambda x: 1, 10000, 0.1, 0.001) is None
+    # named functions that read their parameters from globals are not cached either, since the
+    # same name can mean different parameters
+    risk_functions = []
+    for g in [0.1, 0.2]:
+        namespace = {'TestNonnegMean': TestNonnegMean, 'g': g}
+        exec('def risk_fn(x): return TestNonnegMean.kaplan_wald(x, g=g)', namespace)
+        risk_functions.append(namespace['risk_fn'])
+    assert risk_functions[0].__qualname__ == risk_functions[1].__qualname__ == 'risk_fn'
+    assert [SampleSizeCache.key(f, 10000, 0.1, 0.001) for f in risk_functions] == [None, None]
+    cache = SampleSizeCache()
+    sizes = [cache.initial_sample_size(f, 10000, 0.1, 0.001) for f in risk_functions]
+    assert sizes == [TestNonnegMean.initial_sample_size(f, 10000, 0.1, 0.001) \
+                     for f in risk_functions] and sizes[0] != sizes[1]
+    assert len(cache.entries) == 0
+    assert SampleSizeCache.key(functools.partial(risk_functions[0]), 10000, 0.1, 0.001) is None
+    # array parameters are keyed by all their values
+    assert SampleSizeCache.key(TestNonnegMean.risk_function('kaplan_wald', g=np.zeros(2000)), \
+                               10000, 0.1, 0.001) != \
+           SampleSizeCache.key(TestNonnegMean.risk_function('kaplan_wald', \
+                               g=np.insert(np.zeros(1999), 1000, 0.1)), 10000, 0.1, 0.001)
+
 def test_assorter_mean():
-    pass # [FIX ME]
+    cvr_dict = [{'id': 1, 'votes': {'AvB': {'Alice':True}}},\
+                {'id': 2, 'votes': {'AvB': {'Bob':True}}},\
+                {'id': 3, 'votes': {'AvB': {'Alice':True}}},\
+                {'id': 4, 'votes': {'AvB': {'Alice':True, 'Bob':True}}},\
+                {'id': 5, 'votes': {'CvD': {'Candy':True}}}]
+    cvr_list = CVR.from_dict(cvr_dict)
+    cvr_table = CVRTable.from_cvrs(cvr_list)
+    aVb = Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob'])['Alice v Bob']
+    np.testing.assert_almost_equal(aVb.assorter_mean(cvr_list), 3/5)
+    np.testing.assert_almost_equal(aVb.assorter_mean(cvr_table), 3/5)
+    np.testing.assert_almost_equal(aVb.assorter_sum(cvr_table), 3)
+    patterns, counts, inverse = cvr_table.patterns('AvB')
+    assert len(patterns) == 4 and counts.sum() == 5
+    np.testing.assert_array_equal(inverse[[0, 2]], inverse[0])
+
+    # IRV: the margins from the distinct patterns match those from the CVRs
+    with open('Data/SF2019Nov8Assertions.json') as fid:
+        audit = json.load(fid)['audits'][0]
+    assertions = Assertion.make_assertions_from_json(audit['contest'], \
+                       [audit['winner']] + audit['eliminated'], audit['assertions'])
+    with open('Data/SFDA_2019_Nov8Partial.raire') as fid:
+        cvr_list = CVR.from_raire(list(csv.reader(fid)))[::20]
+    cvr_table = CVRTable.from_cvrs(cvr_list)
+    assert len(cvr_table.patterns('339')[0]) <= 326  # at most 326 rankings of 5 candidates
+    for a in assertions.values():
+        np.testing.assert_almost_equal(a.assorter_mean(cvr_table), a.assorter_mean(cvr_list))
 
 def test_cvr_from_raire():
     raire_cvrs = [['1'],\
@@ -1903,23 +4254,192 @@ def test_cvr_from_raire():
     assert c[2].id == "99813_1_6"
     assert c[2].votes == {'339': {'18':1, '17':2, '15':3, '16':4}, '3': {'2':1}} # merges votes?
 
+def test_cvr_table_from_raire():
+    import io
+    raire_cvrs = [['1'],\
+                  ["Contest","339","5","15","16","17","18","45"],\
+                  ["339","99813_1_1","17"],\
+                  ["339","99813_1_3","16"],\
+                  ["339","99813_1_6","18","17","15","16"],\
+                  ["3","99813_1_6","2"],\
+                  ["339","99813_1_3","15","16"]\
+                 ]
+    from_list = CVRTable.from_raire(raire_cvrs)
+    from_file = CVRTable.from_raire(io.StringIO('\n'.join(','.join(r) for r in raire_cvrs)))
+    merged = CVR.from_raire(raire_cvrs)
+    for table in [from_list, from_file]:
+        assert table.candidates['339'] == ["15","16","17","18","45"]
+        assert [c.id for c in table] == [c.id for c in merged]
+        assert [c.votes for c in table] == [c.votes for c in merged]
+    assert from_list[1].votes == {'339': {'15': 1, '16': 2}}
+    table = CVRTable.from_raire('Data/SFDA2019_PrelimReport9VBMJustDASheets.raire')
+    with open('Data/SFDA2019_PrelimReport9VBMJustDASheets.raire') as fid:
+        merged = CVR.from_raire(list(csv.reader(fid)))
+    assert len(table) == len(merged)
+    for i in range(0, len(merged), 1000):
+        assert table[i].id == merged[i].id and table[i].votes == merged[i].votes
+
+def test_cvr_table_merge():
+    import tempfile
+    with open('Data/SFDA2019_PrelimReport9VBMJustDASheets.raire') as fid:
+        rows = list(csv.reader(fid))
+    header, body = rows[:2], rows[2:]
+    # overlapping pieces, with a second contest for some ballots in the last piece
+    pieces = [body[:60000], body[50000:120000], body[110000:] + [["3", r[1], "2"] for r in body[::500]]]
+    expected = CVRTable.from_raire(header + pieces[0] + pieces[1] + pieces[2])
+    with tempfile.TemporaryDirectory() as d:
+        files = []
+        for i, piece in enumerate(pieces):
+            files.append(os.path.join(d, 'piece_{}.raire'.format(i)))
+            with open(files[-1], 'w', newline='') as f:
+                csv.writer(f).writerows([['2']] + header[1:] + [["Contest","3","1","2"]] + piece)
+        serial = CVRTable.from_files(files, max_workers=1)
+        parallel = CVRTable.from_files(files, max_workers=2)
+    for table in [serial, parallel]:
+        assert len(table) == len(expected)
+        np.testing.assert_array_equal(table.ids, expected.ids)
+        np.testing.assert_array_equal(table.contest_mask('3'), expected.contest_mask('3'))
+        for c in ['339', '3']:
+            np.testing.assert_array_equal(table.rank_matrix(c, expected.candidates[c]), \
+                                          expected.rank_matrix(c, expected.candidates[c]))
+    cvrs = CVRTable.merge([CVRTable.from_cvrs(CVR.from_dict([{'id': 1, 'votes': {}, 'phantom': True}])),
+                           CVRTable.from_cvrs(CVR.from_dict([{'id': 2, 'votes': {'AvB': {'Bob': 1}}}, 
+                                                             {'id': 1, 'votes': {'AvB': {'Alice': 1}}}]))])
+    assert [(c.id, c.votes, c.phantom) for c in cvrs] == [(1, {'AvB': {'Alice': 1}}, False), \
+                                                         (2, {'AvB': {'Bob': 1}}, False)]
+    # integer and string ids together
+    cvrs = CVRTable.merge([CVRTable.from_cvrs(CVR.from_dict([{'id': 1, 'votes': {'AvB': {'Bob': 1}}}])),
+                           CVRTable.from_cvrs(CVR.from_dict([{'id': 'x-1', 'votes': {}}, 
+                                                             {'id': 1, 'votes': {'AvB': {'Alice': 1}}}]))])
+    assert [(c.id, c.votes) for c in cvrs] == [(1, {'AvB': {'Alice': 1}}), ('x-1', {})]
+    empty = CVRTable.merge([])
+    assert len(empty) == 0 and empty.contests == [] and list(empty) == CVR.merge_cvrs([])
+
+def test_cvr_table_cache():
+    import pickle
+    import tempfile
+    cvr_file = 'Data/SFDA2019_PrelimReport9VBMJustDASheets.raire'
+    expected = CVRTable.from_raire(cvr_file)
+    with tempfile.TemporaryDirectory() as d:
+        first = CVRTable.cached(cvr_file, cache_dir=d)
+        assert len(os.listdir(d)) == 1
+        second = CVRTable.cached(cvr_file, cache_dir=d)
+        assert isinstance(second.ranks['339'], np.memmap)
+        for table in [first, second]:
+            np.testing.assert_array_equal(table.ids, expected.ids)
+            np.testing.assert_array_equal(table.phantom, expected.phantom)
+            np.testing.assert_array_equal(table.ranks['339'], expected.ranks['339'])
+            assert table.candidates == expected.candidates
+            assert table[17].votes == expected[17].votes and table[17].id == expected[17].id
+        CVRTable.cached(cvr_file, reader=functools.partial(CVRTable.from_raire, phantom=True), \
+                        cache_dir=d)
+        assert len(os.listdir(d)) == 2
+        # lambdas and local functions are not cached, even inside a partial
+        read = lambda phantom, name: CVRTable.from_raire(name, phantom=phantom)
+        tables = [CVRTable.cached(cvr_file, reader=functools.partial(read, phantom), cache_dir=d) \
+                  for phantom in [True, False]]
+        assert len(os.listdir(d)) == 2
+        assert tables[0].phantom.all() and not tables[1].phantom.any()
+        assert CVRTable.reader_tag(read) is None
+    # readers that differ only in positional arguments, or in their module, have other tags
+    assert CVRTable.reader_tag(functools.partial(CVRTable.from_raire, 'a')) != \
+           CVRTable.reader_tag(functools.partial(CVRTable.from_raire, 'b'))
+    assert json.load.__qualname__ == pickle.load.__qualname__
+    assert CVRTable.reader_tag(json.load) != CVRTable.reader_tag(pickle.load)
+
+def test_cvr_table():
+    cvr_dict = [{'id': 'A-1', 'votes': {'AvB': {}, 'CvD': {'Candy':True}}},\
+                {'id': 'A-2', 'votes': {'CvD': {'Elvis':True, 'Candy':False}}},\
+                {'id': 'A-3', 'votes': {'EvF': {'Bob':1, 'Edie':2}}},\
+                {'id': 'A-1', 'votes': {'EvF': {'Edie':1}}},\
+                {'id': 'A-3', 'votes': {'EvF': {'Edie':3}}},\
+                {'id': 'phantom-1', 'votes': {}, 'phantom': True}]
+    cvr_list = CVR.from_dict(cvr_dict)
+    table = CVRTable.from_cvrs(cvr_list)
+    merged = CVR.merge_cvrs(CVR.from_dict(cvr_dict))
+    assert len(table) == len(merged) == 4
+    for c, m in zip(table, merged):
+        assert c.id == m.id
+        assert c.phantom == m.phantom
+        assert set(c.votes) == set(m.votes)
+        for con in m.votes:
+            for cand in ['Alice', 'Bob', 'Candy', 'Edie', 'Elvis']:
+                assert bool(c.get_votefor(con, cand)) == bool(m.get_votefor(con, cand))
+    assert table[0].has_contest('AvB') and not table[1].has_contest('AvB')
+    assert table[2].votes == {'EvF': {'Edie': 3}}
+    assert table[3].phantom and not table[0].phantom
+    np.testing.assert_array_equal(table.contest_mask('EvF'), [True, False, True, False])
+    np.testing.assert_array_equal(table.rank_matrix('EvF', ['Edie', 'Bob', 'Zed']), \
+                                  [[1, 0, 0], [0, 0, 0], [3, 0, 0], [0, 0, 0]])
+    assert [c.id for c in table[np.array([2, 0])]] == ['A-3', 'A-1']
+    table = CVRTable.from_cvrs(CVR.from_dict([{'id': 1, 'votes': {'AvB': {'Alice': 'marked'}}}]))
+    assert table[0].id == 1 and table[0].get_votefor('AvB', 'Alice') == 1
+
+def test_assort_batch():
+    # the vectorized assorters agree with the scalar assorters on every sample file
+    import glob
+    with open('Data/SF2019Nov8Assertions.json') as fid:
+        audit = json.load(fid)['audits'][0]
+    cands = [audit['winner']] + audit['eliminated']
+    assertions = Assertion.make_assertions_from_json(audit['contest'], cands, audit['assertions'])
+    assertions.update(Assertion.make_plurality_assertions(audit['contest'], ['15'], ['16', '17', '18']))
+    assertions.update(Assertion.make_supermajority_assertion(audit['contest'], '15', \
+                                                             ['16', '17', '18', '45'], 1/2))
+    for f in sorted(glob.glob('Data/*.raire') + glob.glob('Data/mvr*.json')):
+        if f.endswith('.raire'):
+            with open(f) as fid:
+                cvr_list = CVR.from_raire(list(csv.reader(fid)))[::10]  # keep the test quick
+        else:
+            with open(f) as fid:
+                cvr_list = CVR.from_dict(json.load(fid)['ballots'])
+        cvr_table = CVRTable.from_cvrs(cvr_list)
+        for a in assertions.values():
+            scalar = np.array([a.assorter.assort(c) for c in cvr_list])
+            np.testing.assert_array_equal(a.assorter.assort_table(cvr_table), scalar, err_msg=f)
+    # votes that are not integer ranks are interned by their truth value, as CVR.as_vote does
+    votes = [0.5, '0', '', 'marked', 2.0, 0.0, 3, 0, -1, True, False, None, np.int64(2), np.nan]
+    for v in votes:
+        assert CVRTable.as_vote(CVRTable.as_rank(v)) == CVR.as_vote(v), v
+    cvr_list = CVR.from_dict([{'id': i, 'votes': {'AvB': {'Alice': v}}} for i, v in enumerate(votes)])
+    a = Assertion.make_plurality_assertions('AvB', ['Alice'], ['Bob'])['Alice v Bob']
+    np.testing.assert_array_equal(a.assorter.assort_table(CVRTable.from_cvrs(cvr_list)), \
+                                  [a.assorter.assort(c) for c in cvr_list])
+
 if __name__ == "__main__":
     test_cvr_from_raire()
+    test_cvr_table()
+    test_cvr_table_from_raire()
+    test_cvr_table_merge()
+    test_cvr_table_cache()
+    test_sample_size_cache()
     test_cvr_from_dict()
     test_cvr_has_contest()
 
     test_make_plurality_assertions()
     test_supermajority_assorter()
+    test_assorter_spec()
 
     test_overstatement()
     test_overstatement_assorter()
+    test_assorter_mean()
+    test_prep_sample()
     
     test_rcv_lfunc_wo()
     test_rcv_votefor_cand()    
     test_rcv_assorter()
+    test_assort_batch()
     
     test_kaplan_markov()
     test_kaplan_wald()
+    test_running_p_values()
     test_kaplan_kolmogorov()
+    test_wald_sprt()
+    test_integral_from_roots()
+    test_long_samples()
+    test_running_test()
+    test_batched_tests()
+    test_executors()
+    test_run_length_sample()
     test_initial_sample_size()
     test_initial_sample_size_KW()
+    test_new_sample_size()
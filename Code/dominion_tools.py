@@ -1,13 +1,20 @@
 """
 Tools to read and parse Dominion ballot manifests and CVRs
 """
+import os
+import re
+import glob
 import json
 import numpy as np
 import csv
 import pandas as pd
 import warnings
 import copy
-from assertion_audit_utils import CVR
+import functools
+from collections import namedtuple
+from assertion_audit_utils import CVR, CVRTable
+
+ManifestIndex = namedtuple('ManifestIndex', 'batch_row, cart, tray, tabulator, batch, cum_cards')
 
 
 def prep_dominion_manifest(manifest, N_cards, n_cvrs):
@@ -40,13 +47,148 @@ def prep_dominion_manifest(manifest, N_cards, n_cvrs):
         warnings.warn('The CVR list does not account for every card cast in the contest; adding a phantom batch to the manifest')
         r = {'Tray #': None, 'Tabulator Number': 'phantom', 'Batch Number': 1, \
              'Total Ballots': N_cards-n_cvrs, 'VBMCart.Cart number': None}
-        manifest = manifest.append(r, ignore_index = True)
+        manifest = pd.concat([manifest, pd.DataFrame([r])], ignore_index = True)
     manifest['cum_cards'] = manifest['Total Ballots'].cumsum()    
     for c in ['Tray #', 'Tabulator Number', 'Batch Number', 'VBMCart.Cart number']:
         manifest[c] = manifest[c].astype(str)
     return manifest, manifest_cards, N_cards - n_cvrs
 
-def read_dominion_cvrs(cvr_file):
+def dominion_files(cvr_files):
+    """
+    List the Dominion CVR export files to read.
+    
+    Parameters:
+    -----------
+    cvr_files : string or list of strings
+        a filename, a directory (every .json file in it is read, in sorted order), 
+        or a list of filenames
+        
+    Returns:
+    --------
+    list of filenames
+    """
+    if isinstance(cvr_files, (str, os.PathLike)):
+        if os.path.isdir(cvr_files):
+            return sorted(glob.glob(os.path.join(cvr_files, '*.json')))
+        return [cvr_files]
+    return list(cvr_files)
+
+def iter_dominion_sessions(cvr_file, chunk_size=2**20):
+    """
+    Iterate over the sessions in a Dominion CVR export without loading the whole file.
+    
+    The file is read in chunks of chunk_size characters; each element of the "Sessions" 
+    array is decoded as soon as it is complete, so memory use is bounded by the chunk size 
+    and the size of one session.
+    
+    Parameters:
+    -----------
+    cvr_file : string
+        filename for cvrs
+    chunk_size : int
+        number of characters to read at a time
+        
+    Returns:
+    --------
+    generator of dicts, one per session
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile(r'"Sessions"\s*:\s*\[')
+    skip = re.compile(r'[\s,]*')
+    with open(cvr_file, 'r') as f:
+        buf = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+            m = start.search(buf)
+            if m:
+                break
+            buf = buf[-64:]  # the key may straddle two chunks
+        buf, pos = buf[m.end():], 0
+        while True:
+            pos = skip.match(buf, pos).end()
+            if buf.startswith(']', pos):
+                return
+            try:
+                session, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield session
+
+def stream_dominion_cvrs(cvr_files, groups=None, chunk_size=2**20):
+    """
+    Generate CVRs from one or more Dominion CVR exports, one session at a time.
+    Dominion uses:
+       "Id" as the card ID
+       "Marks" as the container for votes
+       "Rank" as the rank
+    
+    Parameters:
+    -----------
+    cvr_files : string or list of strings
+        a filename, a directory of export shards, or a list of filenames. See dominion_files()
+    groups : list of ints
+        if not None, keep only sessions whose "CountingGroupId" is in the list, 
+        e.g., [2] for VBM only
+    chunk_size : int
+        number of characters to read at a time
+        
+    Returns:
+    --------
+    generator of CVR objects
+    """
+    for cvr_file in dominion_files(cvr_files):
+        for c in iter_dominion_sessions(cvr_file, chunk_size=chunk_size):
+            if groups is not None and c.get("CountingGroupId") not in groups:
+                continue
+            # Dominion export wraps the CVRs under several layers; unwrap
+            # Desired output format is
+            # {"ID": "A-001-01", "votes": {"mayor": {"Alice": 1, "Bob": 2, "Candy": 3, "Dan": 4}}}
+            votes = {}
+            for con in c["Original"]["Contests"]:
+                contest_votes = {}
+                for mark in con["Marks"]:
+                    contest_votes[str(mark["CandidateId"])] = mark["Rank"]
+                votes[str(con["Id"])] = contest_votes
+            yield CVR(id = str(c["TabulatorId"])\
+                           + '_' + str(c["BatchId"]) \
+                           + '_' + str(c["RecordId"]),\
+                           votes = votes)
+
+def manifest_index(manifest):
+    """
+    Index a prepared Dominion manifest for fast lookups of many cards at once.
+    
+    Parameters:
+    ----------
+    manifest : dataframe
+        the manifest prepared by prep_dominion_manifest
+    
+    Returns:
+    --------
+    ManifestIndex, a namedtuple with fields
+        batch_row : dict mapping (tabulator, batch), as strings, to the row of the manifest
+        cart, tray, tabulator, batch : arrays of the manifest columns
+        cum_cards : array of the number of cards before each batch, with a final entry
+            for the total number of cards
+    """
+    tabulator = manifest['Tabulator Number'].astype(str).to_numpy()
+    batch = manifest['Batch Number'].astype(str).to_numpy()
+    batch_row = {}
+    for row, key in enumerate(zip(tabulator, batch)):
+        batch_row.setdefault(key, row)
+    return ManifestIndex(batch_row, manifest['VBMCart.Cart number'].to_numpy(), \
+                         manifest['Tray #'].to_numpy(), manifest['Tabulator Number'].to_numpy(), \
+                         manifest['Batch Number'].to_numpy(), \
+                         np.insert(manifest['cum_cards'].to_numpy(), 0, 0))
+
+def read_dominion_cvrs(cvr_file, groups=None):
     """
     Read CVRs in Dominion format.
     Dominion uses:
@@ -54,66 +196,84 @@ def read_dominion_cvrs(cvr_file):
        "Marks" as the container for votes
        "Rank" as the rank
    
-    We want to keep group 2 only (VBM)
+    We want to keep group 2 only (VBM): use groups=[2]
     
     Parameters:
     -----------
-    cvr_file : string
-        filename for cvrs
+    cvr_file : string or list of strings
+        filename for cvrs, a directory of export shards, or a list of filenames
+    groups : list of ints
+        if not None, keep only sessions whose "CountingGroupId" is in the list
         
     Returns:
     --------
     cvr_list : list of CVR objects
        
     """
-    with open(cvr_file, 'r') as f:
-        cvr_json = json.load(f)
-    # Dominion export wraps the CVRs under several layers; unwrap
-    # Desired output format is
-    # {"ID": "A-001-01", "votes": {"mayor": {"Alice": 1, "Bob": 2, "Candy": 3, "Dan": 4}}}
-    cvr_list = []
-    for c in cvr_json['Sessions']:
-        votes = {}
-        for con in c["Original"]["Contests"]:
-            contest_votes = {}
-            for mark in con["Marks"]:
-                contest_votes[str(mark["CandidateId"])] = mark["Rank"]
-            votes[str(con["Id"])] = contest_votes
-        cvr_list.append(CVR(ID = str(c["TabulatorId"])\
-                                 + '_' + str(c["BatchId"]) \
-                                 + '_' + str(c["RecordId"]),\
-                                 votes = votes))
-    return cvr_list
-
-def sample_from_manifest(manifest, sample):
+    return list(stream_dominion_cvrs(cvr_file, groups=groups))
+
+def read_dominion_cvr_table(cvr_file, groups=None, max_workers=1):
+    """
+    Read CVRs in Dominion format into a CVRTable, streaming the sessions so that neither
+    the JSON tree nor a list of CVR objects is ever held in memory.
+    
+    If there are several files and max_workers != 1, the files are parsed in a pool of
+    worker processes and merged in file order (see CVRTable.from_files).
+    
+    Parameters:
+    -----------
+    cvr_file : string or list of strings
+        filename for cvrs, a directory of export shards, or a list of filenames
+    groups : list of ints
+        if not None, keep only sessions whose "CountingGroupId" is in the list
+    max_workers : int
+        number of worker processes; None for one per CPU
+        
+    Returns:
+    --------
+    CVRTable
+    """
+    files = dominion_files(cvr_file)
+    if max_workers == 1 or len(files) <= 1:
+        return CVRTable.from_cvrs(stream_dominion_cvrs(files, groups=groups))
+    return CVRTable.from_files(files, reader=functools.partial(read_dominion_cvr_table, \
+                               groups=groups), max_workers=max_workers)
+
+def sample_from_manifest(manifest, sample, index=None):
     """
     Sample from the ballot manifest
     
+    The whole sample is resolved at once: one searchsorted call finds the batch of every card,
+    and the manifest columns are gathered with fancy indexing.
+    
     Parameters:
     -----------
     manifest : dataframe
         the processed Dominion manifest
     sample : list of ints
         the cards to sample    
+    index : ManifestIndex
+        the index of the manifest from manifest_index(). If None, it is built from the manifest.
         
     Returns:
     -------
-    sorted list of card identifiers corresponding to the sample. Card identifiers are 1-indexed
+    list of card identifiers corresponding to the sample, in the order of the sample. 
+    Card identifiers are 1-indexed
     """
-    cards = []
-    lookup = np.array([0] + list(manifest['cum_cards']))
-    for s in sample:
-        batch_num = int(np.searchsorted(lookup, s, side='left'))
-        card_in_batch = int(s-lookup[batch_num-1])
-        tab = manifest.iloc[batch_num-1]['Tabulator Number']
-        batch = manifest.iloc[batch_num-1]['Batch Number']
-        card = list(manifest.iloc[batch_num-1][['VBMCart.Cart number','Tray #']]) \
-                + [tab, batch, card_in_batch, str(tab)+'-'+str(batch)\
-                + '-'+str(card_in_batch), s]
-        cards.append(card)
-    return cards
+    index = manifest_index(manifest) if index is None else index
+    sample = np.asarray(sample, dtype=np.int64)
+    lookup = index.cum_cards
+    if np.any(sample < 1) or np.any(sample > lookup[-1]):
+        raise ValueError("sample contains cards not in the manifest")
+    rows = np.searchsorted(lookup, sample, side='left') - 1
+    card_in_batch = (sample - lookup[rows]).tolist()
+    tab = index.tabulator[rows].tolist()
+    batch = index.batch[rows].tolist()
+    imprint = [str(t)+'-'+str(b)+'-'+str(c) for t, b, c in zip(tab, batch, card_in_batch)]
+    return [list(card) for card in zip(index.cart[rows].tolist(), index.tray[rows].tolist(), \
+                                       tab, batch, card_in_batch, imprint, sample.tolist())]
 
-def sample_from_cvr(cvr_list, manifest, sample):
+def sample_from_cvr(cvr_list, manifest, sample, index=None):
     """
     Sample from a list of CVRs. 
     Return information needed to find the corresponding cards, the CVRs in the sample, 
@@ -121,11 +281,14 @@ def sample_from_cvr(cvr_list, manifest, sample):
     
     Parameters:
     -----------
-    cvr_list : list of CVR objects. This function assumes that the id for the cvr is composed
-        of a scanner number, batch number, and ballot number, joined with underscores
+    cvr_list : list of CVR objects, or a CVRTable. This function assumes that the id for the
+        cvr is composed of a scanner number, batch number, and ballot number, joined with hyphens
     manifest : a ballot manifest as a pandas dataframe
     sample : list of ints
         the CVRs to sample    
+    index : ManifestIndex
+        the index of the manifest from manifest_index(). If None, it is built from the manifest.
+        Pass it in to avoid rebuilding it for every sample drawn from the same manifest.
         
     Returns:
     -------
@@ -133,23 +296,31 @@ def sample_from_cvr(cvr_list, manifest, sample):
     cvr_sample: the CVRs in the sample
     mvr_phantoms : list of CVR objects, the mvrs for phantom sheets in the sample
     """
+    index = manifest_index(manifest) if index is None else index
+    sample = np.asarray(sample, dtype=np.int64) - 1
+    if isinstance(cvr_list, CVRTable):
+        cvr_sample = cvr_list[sample]
+    else:
+        cvr_sample = [cvr_list[s] for s in sample]
+    parts = [str(c.id).split("-") for c in cvr_sample]
+    phantom = np.array([c.phantom for c in cvr_sample], dtype=bool)
+    rows = np.array([index.batch_row.get((tab, batch), -1) for tab, batch, card_num in parts], \
+                    dtype=np.int64)
+    unknown = ~phantom & (rows < 0)
+    if np.any(unknown):
+        raise ValueError("cvrs {} are not in the manifest".format(\
+                         [c.id for c, u in zip(cvr_sample, unknown) if u]))
+    carts = index.cart[rows].tolist()
+    trays = index.tray[rows].tolist()
     cards = []
-    cvr_sample = []
     mvr_phantoms = []
-    for s in sample-1:
-        cvr_sample.append(cvr_list[s])
-        cvr_id = cvr_list[s].id
-        tab, batch, card_num = cvr_id.split("-")
-        if not cvr_list[s].phantom:
-            manifest_row = manifest[(manifest['Tabulator Number'] == str(tab)) \
-                                    & (manifest['Batch Number'] == str(batch))].iloc[0]
-            card = [manifest_row['VBMCart.Cart number'],\
-                    manifest_row['Tray #']] \
-                    + [tab, batch, card_num, str(tab)+'-'+str(batch)\
-                    + '-'+str(card_num), s]
+    for i, (tab, batch, card_num) in enumerate(parts):
+        imprint = str(tab)+'-'+str(batch)+'-'+str(card_num)
+        if not phantom[i]:
+            card = [carts[i], trays[i], tab, batch, card_num, imprint, sample[i]]
         else:
-            card = ["","", tab, batch, card_num, str(tab)+'-'+str(batch) + '-'+str(card_num), s]
-            mvr_phantoms.append(CVR(id=cvr_id, votes = {}, phantom=True))
+            card = ["","", tab, batch, card_num, imprint, sample[i]]
+            mvr_phantoms.append(CVR(id=cvr_sample[i].id, votes = {}, phantom=True))
         cards.append(card)
     # sort by id
     cards.sort(key = lambda x: x[5])
@@ -210,6 +381,70 @@ def test_sample_from_manifest():
     assert cards[4] == [2, 2, 18, 2, 21, "18-2-21",121]
     assert cards[5] == [2, 2, 18, 2, 100, "18-2-100",200]
     assert cards[6] == [3, 3, 19, 3, 1, "19-3-1",201]  
+    assert sample_from_manifest(manifest, sample[::-1], index=manifest_index(manifest)) == cards[::-1]
+    for bad in [[0], [301]]:
+        try:
+            sample_from_manifest(manifest, bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError
+
+def test_sample_from_cvr():
+    """
+    Test looking up sampled CVRs in the manifest
+    """
+    d = [{'Tray #': 1, 'Tabulator Number': 17, 'Batch Number': 1, 'Total Ballots': 2, 'VBMCart.Cart number': 1},\
+        {'Tray #': 2, 'Tabulator Number': 18, 'Batch Number': 2, 'Total Ballots': 2, 'VBMCart.Cart number': 2}]
+    manifest, manifest_cards, phantom_cards = prep_dominion_manifest(pd.DataFrame.from_dict(d), 5, 4)
+    assert manifest_cards == 4 and phantom_cards == 1
+    cvr_list = CVR.from_dict([{'id': '17-1-1', 'votes': {}}, {'id': '17-1-2', 'votes': {}}, \
+                              {'id': '18-2-1', 'votes': {}}, {'id': '18-2-2', 'votes': {}}, \
+                              {'id': 'phantom-1-1', 'votes': {}, 'phantom': True}])
+    for cvrs in [cvr_list, CVRTable.from_cvrs(cvr_list)]:
+        cards, cvr_sample, mvr_phantoms = sample_from_cvr(cvrs, manifest, np.array([5, 3, 2]))
+        assert [c.id for c in cvr_sample] == ['phantom-1-1', '18-2-1', '17-1-2']
+        assert cards[0] == ['1', '1', '17', '1', '2', '17-1-2', 1]
+        assert cards[1] == ['2', '2', '18', '2', '1', '18-2-1', 2]
+        assert cards[2] == ['', '', 'phantom', '1', '1', 'phantom-1-1', 4]
+        assert [m.id for m in mvr_phantoms] == ['phantom-1-1'] and mvr_phantoms[0].phantom
+    try:
+        sample_from_cvr(CVR.from_dict([{'id': '19-1-1', 'votes': {}}]), manifest, [1])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError
+
+def test_read_dominion_cvrs():
+    """
+    Test the streaming Dominion reader, across chunk boundaries, shards and group filters
+    """
+    import tempfile
+    def session(tab, batch, rec, group, marks):
+        return {"TabulatorId": tab, "BatchId": batch, "RecordId": rec, "CountingGroupId": group,
+                "Original": {"Contests": [{"Id": 339, "Marks": [{"CandidateId": cand, "Rank": rank} \
+                                          for cand, rank in marks]}]}}
+    shards = [{"Version": "5.2.16.1", "ElectionId": "N19", "Sessions": \
+                 [session(1, 2, 3, 2, [(15, 1), (16, 2)]), session(1, 2, 4, 1, [(17, 1)])]},
+              {"Version": "5.2.16.1", "ElectionId": "N19", "Sessions": \
+                 [session(5, 6, 7, 2, [(18, 1)])]}]
+    with tempfile.TemporaryDirectory() as d:
+        for i, shard in enumerate(shards):
+            with open(os.path.join(d, 'CvrExport_{}.json'.format(i)), 'w') as f:
+                json.dump(shard, f, indent=2)
+        sessions = list(iter_dominion_sessions(os.path.join(d, 'CvrExport_0.json'), chunk_size=7))
+        assert sessions == shards[0]["Sessions"]
+        cvrs = read_dominion_cvrs(d)
+        assert [c.id for c in cvrs] == ['1_2_3', '1_2_4', '5_6_7']
+        assert cvrs[0].votes == {'339': {'15': 1, '16': 2}}
+        cvrs = read_dominion_cvrs(d, groups=[2])
+        assert [c.id for c in cvrs] == ['1_2_3', '5_6_7']
+        table = read_dominion_cvr_table(d, groups=[2])
+        assert [c.votes for c in table] == [c.votes for c in cvrs]
+        table = read_dominion_cvr_table(d, groups=[2], max_workers=2)
+        assert [(c.id, c.votes) for c in table] == [(c.id, c.votes) for c in cvrs]
 
 if __name__ == "__main__":
     test_sample_from_manifest()
+    test_sample_from_cvr()
+    test_read_dominion_cvrs()
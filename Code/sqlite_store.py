@@ -0,0 +1,342 @@
+"""
+SQLite-backed storage for the CVRs, MVRs, ballot manifest and sampled cards of an audit
+"""
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+from assertion_audit_utils import CVR
+
+
+class AuditStore:
+    """
+    Store the data for an audit in a SQLite database (stdlib sqlite3), so that audits too large
+    to hold in memory can still run, and so that lookups by ballot id, imprint, or
+    (tabulator, batch) use indexes instead of scanning lists.
+
+    Tables:
+    -------
+    cvrs : one row per CVR, in the order the CVRs were added. `row` is the 0-based position
+        of the CVR in that order, i.e., the index used by sample_from_cvr. Indexed by id.
+    mvrs : one row per MVR, keyed by id. Adding an MVR with an id already in the table
+        replaces it, so the cumulative MVR file for each round can simply be re-added.
+    manifest : the prepared Dominion manifest (see dominion_tools.prep_dominion_manifest),
+        indexed by (tabulator, batch) and by cumulative card count
+    sampled : the cards selected in each round, in selection order, indexed by imprint
+
+    Votes are stored as json.
+    """
+
+    def __init__(self, path=':memory:'):
+        """
+        Open (and if necessary, create) a store.
+
+        Parameters:
+        -----------
+        path : string
+            filename for the database; ':memory:' for a temporary in-memory database
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS cvrs (row INTEGER PRIMARY KEY, id NOT NULL,
+                                             phantom INTEGER NOT NULL, votes TEXT NOT NULL);
+            CREATE UNIQUE INDEX IF NOT EXISTS cvrs_id ON cvrs (id);
+            CREATE TABLE IF NOT EXISTS mvrs (id PRIMARY KEY, phantom INTEGER NOT NULL,
+                                             votes TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS manifest (row INTEGER PRIMARY KEY, cart TEXT, tray TEXT,
+                                                 tabulator TEXT, batch TEXT,
+                                                 total INTEGER, cum_cards INTEGER);
+            CREATE INDEX IF NOT EXISTS manifest_batch ON manifest (tabulator, batch);
+            CREATE INDEX IF NOT EXISTS manifest_cum_cards ON manifest (cum_cards);
+            CREATE TABLE IF NOT EXISTS sampled (round INTEGER, position INTEGER, cvr_row INTEGER,
+                                                cart TEXT, tray TEXT, tabulator TEXT, batch TEXT,
+                                                card TEXT, imprint TEXT,
+                                                PRIMARY KEY (round, position));
+            CREATE INDEX IF NOT EXISTS sampled_imprint ON sampled (imprint);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    @classmethod
+    def _cvr(cls, id, phantom, votes):
+        return CVR(id=id, votes=json.loads(votes), phantom=bool(phantom))
+
+    def add_cvrs(self, cvr_list, batch_size=10000):
+        """
+        Append CVRs to the store. CVRs are numbered in the order they are added.
+
+        Parameters:
+        -----------
+        cvr_list : iterable of CVR objects (e.g., a list or a CVRTable)
+        batch_size : int
+            number of CVRs to insert per statement batch
+        """
+        start = self.n_cvrs()
+        rows = []
+        for i, c in enumerate(cvr_list):
+            rows.append((start + i, c.id, int(c.phantom), json.dumps(c.votes)))
+            if len(rows) == batch_size:
+                self.db.executemany("INSERT INTO cvrs VALUES (?, ?, ?, ?)", rows)
+                rows = []
+        self.db.executemany("INSERT INTO cvrs VALUES (?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def add_mvrs(self, mvr_list):
+        """
+        Add (or replace) MVRs.
+
+        Parameters:
+        -----------
+        mvr_list : iterable of CVR objects
+        """
+        self.db.executemany("INSERT OR REPLACE INTO mvrs VALUES (?, ?, ?)", \
+                            ((m.id, int(m.phantom), json.dumps(m.votes)) for m in mvr_list))
+        self.db.commit()
+
+    def add_manifest(self, manifest):
+        """
+        Replace the manifest.
+
+        Parameters:
+        -----------
+        manifest : dataframe
+            a manifest prepared by dominion_tools.prep_dominion_manifest
+        """
+        self.db.execute("DELETE FROM manifest")
+        cols = ['VBMCart.Cart number', 'Tray #', 'Tabulator Number', 'Batch Number']
+        rows = zip(range(len(manifest)), *[manifest[c].astype(str) for c in cols], \
+                   manifest['Total Ballots'].astype(int).tolist(), \
+                   manifest['cum_cards'].astype(int).tolist())
+        self.db.executemany("INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+
+    def n_cvrs(self):
+        return self.db.execute("SELECT COUNT(*) FROM cvrs").fetchone()[0]
+
+    def get_cvrs(self, rows):
+        """
+        The CVRs at the given 0-based positions, in the order requested.
+
+        Parameters:
+        -----------
+        rows : list of ints
+
+        Returns:
+        --------
+        list of CVR objects
+        """
+        rows = [int(r) for r in rows]
+        found = {}
+        for k in range(0, len(rows), 900):  # stay below SQLite's limit on parameters
+            chunk = rows[k:k+900]
+            q = "SELECT row, id, phantom, votes FROM cvrs WHERE row IN ({})".format(\
+                ','.join('?'*len(chunk)))
+            for r, id, phantom, votes in self.db.execute(q, chunk):
+                found[r] = AuditStore._cvr(id, phantom, votes)
+        missing = [r for r in rows if r not in found]
+        if missing:
+            raise IndexError("no CVR at positions {}".format(missing))
+        return [found[r] for r in rows]
+
+    def get_mvrs(self, ids):
+        """
+        The MVRs with the given ids, in the order requested; None for ids with no MVR.
+
+        Parameters:
+        -----------
+        ids : list of ballot ids
+
+        Returns:
+        --------
+        list of CVR objects (or None)
+        """
+        ids = list(ids)
+        found = {}
+        for k in range(0, len(ids), 900):
+            chunk = ids[k:k+900]
+            q = "SELECT id, phantom, votes FROM mvrs WHERE id IN ({})".format(\
+                ','.join('?'*len(chunk)))
+            for id, phantom, votes in self.db.execute(q, chunk):
+                found[id] = AuditStore._cvr(id, phantom, votes)
+        return [found.get(i) for i in ids]
+
+    def find_batch(self, tabulator, batch):
+        """
+        cart and tray for a batch in the manifest, or None if it is not in the manifest
+        """
+        return self.db.execute("SELECT cart, tray FROM manifest WHERE tabulator=? AND batch=?", \
+                               (str(tabulator), str(batch))).fetchone()
+
+    def find_imprint(self, imprint):
+        """
+        (round, position, cvr_row) for every time the card with this imprint was sampled
+        """
+        return self.db.execute("SELECT round, position, cvr_row FROM sampled WHERE imprint=? \
+                                ORDER BY round, position", (imprint,)).fetchall()
+
+    def sample_from_cvr(self, sample, round=1):
+        """
+        Sample from the stored CVRs, as dominion_tools.sample_from_cvr does, and record the
+        sampled cards for the round.
+
+        Parameters:
+        -----------
+        sample : list of ints
+            the CVRs to sample (1-indexed)
+        round : int
+            the round of the audit; the cards are stored under this round number
+
+        Returns:
+        -------
+        cards: sorted list of card identifiers corresponding to the sample.
+        cvr_sample: the CVRs in the sample
+        mvr_phantoms : list of CVR objects, the mvrs for phantom sheets in the sample
+        """
+        rows = [int(s) - 1 for s in sample]
+        cvr_sample = self.get_cvrs(rows)
+        cards = []
+        mvr_phantoms = []
+        unknown = []
+        for s, cvr in zip(rows, cvr_sample):
+            tab, batch, card_num = cvr.id.split("-")
+            imprint = str(tab) + '-' + str(batch) + '-' + str(card_num)
+            if not cvr.phantom:
+                found = self.find_batch(tab, batch)
+                if found is None:
+                    unknown.append(cvr.id)
+                    continue
+                cart, tray = found
+                card = [cart, tray, tab, batch, card_num, imprint, s]
+            else:
+                card = ["", "", tab, batch, card_num, imprint, s]
+                mvr_phantoms.append(CVR(id=cvr.id, votes={}, phantom=True))
+            cards.append(card)
+        if unknown:
+            raise ValueError("cvrs {} are not in the manifest".format(unknown))
+        self.db.execute("DELETE FROM sampled WHERE round=?", (round,))
+        self.db.executemany("INSERT INTO sampled VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+                            ((round, i, c[6]) + tuple(c[:6]) for i, c in enumerate(cards)))
+        self.db.commit()
+        cards.sort(key = lambda x: x[5])
+        return cards, cvr_sample, mvr_phantoms
+
+    def sampled_rows(self, rounds=None):
+        """
+        positions of the sampled CVRs, in the order they were sampled
+
+        Parameters:
+        -----------
+        rounds : list of ints
+            rounds to include; None for all rounds
+        """
+        q = "SELECT cvr_row FROM sampled"
+        args = ()
+        if rounds is not None:
+            rounds = list(rounds)
+            q += " WHERE round IN ({})".format(','.join('?'*len(rounds)))
+            args = rounds
+        return [r[0] for r in self.db.execute(q + " ORDER BY round, position", args)]
+
+    def prep_sample(self, cvr_sample):
+        """
+        The MVRs for a sample of CVRs, in the same order, found by indexed id lookups.
+
+        Phantom CVRs that have no stored MVR get a phantom MVR.
+
+        Parameters:
+        -----------
+        cvr_sample : list of CVR objects
+
+        Returns:
+        --------
+        mvr_sample : list of CVR objects, aligned with cvr_sample
+        """
+        mvr_sample = self.get_mvrs([c.id for c in cvr_sample])
+        missing = []
+        for i, (m, c) in enumerate(zip(mvr_sample, cvr_sample)):
+            if m is None:
+                if c.phantom:
+                    mvr_sample[i] = CVR(id=c.id, votes={}, phantom=True)
+                else:
+                    missing.append(c.id)
+        if missing:
+            raise ValueError("no MVR for cvrs {}".format(missing))
+        return mvr_sample
+
+    def sample_pairs(self, rounds=None):
+        """
+        Aligned MVRs and CVRs for the sampled cards, ready for find_p_values.
+
+        Parameters:
+        -----------
+        rounds : list of ints
+            rounds to include; None for all rounds
+
+        Returns:
+        --------
+        mvr_sample : list of CVR objects
+        cvr_sample : list of CVR objects
+        """
+        cvr_sample = self.get_cvrs(self.sampled_rows(rounds))
+        return self.prep_sample(cvr_sample), cvr_sample
+
+
+def test_audit_store():
+    import os
+    import tempfile
+    cvrs = CVR.from_dict([{'id': '17-1-1', 'votes': {'AvB': {'Alice': True}}},
+                          {'id': '18-2-1', 'votes': {'AvB': {'Bob': True}}},
+                          {'id': '18-2-2', 'votes': {'AvB': {}}},
+                          {'id': 'phantom-1-1', 'votes': {}, 'phantom': True}])
+    manifest = pd.DataFrame.from_dict([{'Tray #': 1, 'Tabulator Number': 17, 'Batch Number': 1,
+                                        'Total Ballots': 1, 'VBMCart.Cart number': 1},
+                                       {'Tray #': 2, 'Tabulator Number': 18, 'Batch Number': 2,
+                                        'Total Ballots': 2, 'VBMCart.Cart number': 3}])
+    manifest['cum_cards'] = manifest['Total Ballots'].cumsum()
+    with tempfile.TemporaryDirectory() as d:
+        with AuditStore(os.path.join(d, 'audit.db')) as store:
+            store.add_cvrs(cvrs[:2])
+            store.add_cvrs(cvrs[2:])
+            store.add_manifest(manifest)
+            store.add_mvrs(CVR.from_dict([{'id': '18-2-2', 'votes': {'AvB': {'Alice': True}}}]))
+        with AuditStore(os.path.join(d, 'audit.db')) as store:
+            assert store.n_cvrs() == 4
+            assert store.find_batch(18, 2) == ('3', '2')
+            cards, cvr_sample, mvr_phantoms = store.sample_from_cvr(np.array([4, 3, 1]))
+            assert [c.id for c in cvr_sample] == ['phantom-1-1', '18-2-2', '17-1-1']
+            assert cards[0] == ['1', '1', '17', '1', '1', '17-1-1', 0]
+            assert cards[1] == ['3', '2', '18', '2', '2', '18-2-2', 2]
+            assert [m.id for m in mvr_phantoms] == ['phantom-1-1']
+            assert store.find_imprint('18-2-2') == [(1, 1, 2)]
+            try:
+                store.sample_pairs()
+            except ValueError:
+                pass
+            else:
+                raise AssertionError
+            store.add_mvrs(CVR.from_dict([{'id': '17-1-1', 'votes': {'AvB': {'Alice': True}}},
+                                          {'id': '18-2-2', 'votes': {'AvB': {'Bob': True}}}]))
+            mvr_sample, cvr_sample = store.sample_pairs()
+            assert [m.id for m in mvr_sample] == [c.id for c in cvr_sample]
+            assert mvr_sample[0].phantom and mvr_sample[1].votes == {'AvB': {'Bob': True}}
+            # a sampled card whose batch is not in the manifest
+            store.add_cvrs(CVR.from_dict([{'id': '19-5-1', 'votes': {'AvB': {'Bob': True}}}]))
+            try:
+                store.sample_from_cvr(np.array([5, 1]))
+            except ValueError as e:
+                assert '19-5-1' in str(e)
+            else:
+                raise AssertionError
+            assert store.find_imprint('17-1-1') == [(1, 2, 0)]  # round 1 is unchanged
+
+if __name__ == "__main__":
+    test_audit_store()